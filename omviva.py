@@ -1,31 +1,76 @@
-from malog import setupLogging
 from datetime import datetime
+import time
 
-from aiomqtt import Client
-from omviva_comms import OmronBLE
+# bleak, aiomqtt, paramiko and scp are slow to import, they are imported by the functions using them,
+# so every command (see main) only loads the transports it needs
 import asyncio
 import json
 from pathlib import Path
 from omviva_persistence import VivaPersistence
-from bleak import BleakScanner
-from bleak.backends.device import BLEDevice
-from bleak.assigned_numbers import AdvertisementDataType
-from bleak.backends.bluezdbus.advertisement_monitor import OrPattern
-from bleak.backends.bluezdbus.scanner import BlueZScannerArgs
-from bleak.backends.scanner import AdvertisementData
-from scp import SCPClient
-import paramiko
+from omviva_metrics import metrics
+import omviva_replication
+from omviva_replication import build_changeset, CHANGESET_NAME
+import io
+import shlex
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
 from signal import SIGINT, SIGTERM
 import sys
 import argparse
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from bleak.backends.device import BLEDevice
+    from bleak.backends.scanner import AdvertisementData
 
 
 logger = None
 config = None
-isReading = False
-scanner = None
+# the configured scales, see get_scales
+scales = []
+uploader = None
+publisher = None
+# VivaPersistence shared by all syncs while the service runs
+writer = None
+# None for bleak.BleakClient, omviva_bench sets the simulated scale here
+ble_client_factory = None
 
 DATABASE_NAME = "viva_measurements.db"
+DEVICE_CACHE_NAME = "omviva_devices.json"
+# records per transaction while a transfer is running
+PERSIST_BATCH_SIZE = 10
+# uploads requested within this time are merged into one
+UPLOAD_DELAY_SECONDS = 5
+SSH_KEEPALIVE_SECONDS = 30
+MQTT_RECONNECT_SECONDS = 10
+# failed attempts in a row after which a sync gives up, attempts that stored new records do not count
+SYNC_ATTEMPTS = 4
+# failure kind (see failure_kind) -> (seconds before the first retry, maximum seconds),
+# the delay doubles with every further failure of the same kind
+RETRY_BACKOFF = {
+    "not_found": (10, 120),
+    "pairing": (5, 60),
+    "timeout": (2, 30),
+    "other": (2, 30),
+}
+# attempts in a row that did not find the scale before its syncs are paused, and for how long
+BREAKER_THRESHOLD = 3
+BREAKER_SECONDS = 600
+# concurrent connections per Bluetooth adapter
+ADAPTER_CONNECTIONS = 1
+# measurements published per outbox query
+OUTBOX_BATCH_SIZE = 50
+
+# Home Assistant sensors: measurements column -> (name, unit, device class, factor for the value)
+DISCOVERY_SENSORS = {
+    "Weight": ("Weight", "kg", "weight", 1),
+    "BMI": ("BMI", None, None, 1),
+    "BodyFatPercentage": ("Body fat", "%", None, 100),
+    "SkeletalMusclePercentage": ("Skeletal muscle", "%", None, 100),
+    "VisceralFatLevel": ("Visceral fat level", None, None, 1),
+    "BasalMetabolism": ("Basal metabolism", "kcal", None, 1),
+    "BodyAge": ("Body age", "a", None, 1),
+}
 
 
 def signal_handler():
@@ -36,33 +81,455 @@ def signal_handler():
 async def mqtt_listener():
     # this assumes that "something" is informing us that the Omron VIVA is ready to be read
     # this something can be a bluetooth passive scanning script on a shelly bluetooth device
+    # the connection stays open for the lifetime of the process and is reestablished if the broker goes away
+    from aiomqtt import Client, MqttError
+
+    while True:
+        try:
+            async with Client(config["MQTT_HOST"], port=config.get("MQTT_PORT", 1883)) as client:
+                for topic in sorted({scale.mqtt_topic for scale in scales}):
+                    await client.subscribe(topic)
+                async for message in client.messages:
+                    logger.debug(f"Got sync command via MQTT on {message.topic} with {message.payload.decode()}")
+                    for scale in scales:
+                        if message.topic.matches(scale.mqtt_topic):
+                            scale.dispatcher.trigger("MQTT")
+        except MqttError as e:
+            logger.error(f"MQTT connection lost, reconnecting in {MQTT_RECONNECT_SECONDS}s: {e}")
+            await asyncio.sleep(MQTT_RECONNECT_SECONDS)
+        except asyncio.CancelledError:
+            logger.info("MQTT listener cancelled")
+            raise
+
+
+class Scale:
+    # one configured scale, with the adapter it is reached through and its sync state
+    # the users of the scale are stored with UserID = user + user_offset, so several scales can share the database
+
+    def __init__(self, name, mac, users, user_offset, adapter, mqtt_topic, breaker):
+        self.name = name
+        self.mac = mac
+        self.users = users
+        self.user_offset = user_offset
+        self.adapter = adapter
+        self.mqtt_topic = mqtt_topic
+        self.breaker = breaker
+        self.reading = False
+        self.dispatcher = None
+        # OmronBLE, kept between syncs
+        self.viva = None
+
+
+class Adapter:
+    # a Bluetooth adapter (None for the default one) with at most ADAPTER_CONNECTIONS scales connected at a time
+    # its passive scanner pauses while any scale is connected
+
+    def __init__(self, name, limit):
+        self.name = name
+        self.slots = asyncio.Semaphore(limit)
+        self.lock = asyncio.Lock()
+        self.connected = 0
+        self.scanner = None
+
+    @asynccontextmanager
+    async def connection(self):
+        async with self.slots:
+            async with self.lock:
+                self.connected += 1
+                if self.connected == 1 and self.scanner is not None:
+                    await self.scanner.stop()
+            try:
+                yield
+            finally:
+                async with self.lock:
+                    self.connected -= 1
+                    if self.connected == 0 and self.scanner is not None:
+                        await self.scanner.start()
+
+
+class CircuitBreaker:
+    # opens after `threshold` attempts in a row failed because the scale was not found,
+    # syncs are skipped while it is open, the first sync after `seconds` tries again
+
+    def __init__(self, threshold, seconds):
+        self.threshold = threshold
+        self.seconds = seconds
+        self.failures = 0
+        self.open_until = None
+
+    def is_open(self):
+        return self.open_until is not None and time.monotonic() < self.open_until
+
+    def record(self, kind):
+        # kind of a failed attempt, None after a successful one, returns True if the breaker opened
+        if kind != "not_found":
+            self.reset()
+            return False
+        self.failures += 1
+        if self.failures < self.threshold:
+            return False
+        self.open_until = time.monotonic() + self.seconds
+        return True
+
+    def reset(self):
+        self.failures = 0
+        self.open_until = None
+
+
+def get_scales(config):
+    # the scales listed in DEVICES, or the single scale given by VIVA_MAC and NO_OF_USERS
+    devices = config.get("DEVICES") or [
+        {"NAME": "viva", "VIVA_MAC": config["VIVA_MAC"], "NO_OF_USERS": config["NO_OF_USERS"]}
+    ]
+    adapters = {}
+    result = []
+    for device in devices:
+        adapterName = device.get("ADAPTER", config.get("ADAPTER"))
+        if adapterName not in adapters:
+            adapters[adapterName] = Adapter(adapterName, config.get("ADAPTER_CONNECTIONS", ADAPTER_CONNECTIONS))
+        result.append(
+            Scale(
+                name=device.get("NAME", device["VIVA_MAC"]),
+                mac=device["VIVA_MAC"],
+                users=device["NO_OF_USERS"],
+                user_offset=device.get("USER_OFFSET", 0),
+                adapter=adapters[adapterName],
+                mqtt_topic=device.get("MQTT_TOPIC", config.get("MQTT_TOPIC")),
+                breaker=CircuitBreaker(
+                    config.get("BREAKER_THRESHOLD", BREAKER_THRESHOLD), config.get("BREAKER_SECONDS", BREAKER_SECONDS)
+                ),
+            )
+        )
+    # scales sharing a UserID would share its records and checkpoint, the second scale's records would be skipped
+    owners = {}
+    for scale in result:
+        for userId in range(scale.user_offset + 1, scale.user_offset + scale.users + 1):
+            if userId in owners:
+                raise ValueError(f"User {userId} of {scale.name} is also used by {owners[userId]}, set USER_OFFSET")
+            owners[userId] = scale.name
+    return result
+
+
+def get_scale(name):
+    if name is None:
+        return scales[0]
+    for scale in scales:
+        if name in (scale.name, scale.mac):
+            return scale
+    raise ValueError(f"Unknown device {name}")
+
+
+class SyncDispatcher:
+    # all triggers (MQTT messages, BLE sightings) of a scale end up here and a single worker runs its syncs
+    # triggers are merged: at most one trigger waits while a sync is running, a sync starts TRIGGER_DEBOUNCE
+    # seconds after its trigger and not earlier than TRIGGER_COOLDOWN seconds after the previous sync ended
+    # every scale has its own dispatcher, so different scales sync at the same time (within the adapter limits)
+
+    def __init__(self, scale, debounce, cooldown):
+        self.scale = scale
+        self.queue = asyncio.Queue(maxsize=1)
+        self.debounce = debounce
+        self.cooldown = cooldown
+        self.last_sync_end = None
+
+    def trigger(self, source):
+        metrics.count("triggers")
+        try:
+            self.queue.put_nowait(source)
+            logger.info(f"Sync of {self.scale.name} triggered via {source}")
+        except asyncio.QueueFull:
+            metrics.count("triggers_merged")
+            logger.debug(f"Sync of {self.scale.name} already pending, merged trigger via {source}")
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            source = await self.queue.get()
+            delay = self.debounce
+            if self.last_sync_end is not None:
+                delay = max(delay, self.last_sync_end + self.cooldown - loop.time())
+            await asyncio.sleep(delay)
+            # triggers that arrived while waiting are covered by this sync
+            while not self.queue.empty():
+                self.queue.get_nowait()
+                metrics.count("triggers_merged")
+
+            logger.info(f"Starting sync of {self.scale.name} (triggered via {source})")
+            try:
+                with metrics.span("sync"):
+                    await sync(self.scale)
+                logger.info(f"Sync of {self.scale.name} done")
+            except Exception as e:
+                logger.error(f"Sync of {self.scale.name} failed: {e}")
+            self.last_sync_end = loop.time()
+            if config.get("METRICS_MQTT_TOPIC"):
+                await publish_metrics()
+
+
+async def run_service(trigger_source):
+    global writer
     loop = asyncio.get_running_loop()
     loop.add_signal_handler(SIGINT, signal_handler)
     loop.add_signal_handler(SIGTERM, signal_handler)
-    async with Client(config["MQTT_HOST"]) as client:
-        await client.subscribe(config["MQTT_TOPIC"])
+    # one connection writes for all scales, its transactions never interleave as they run on this thread
+    writer = VivaPersistence(db_name=DATABASE_NAME, outbox=publisher is not None)
+    tasks = [trigger_source()]
+    for scale in scales:
+        scale.dispatcher = SyncDispatcher(scale, config.get("TRIGGER_DEBOUNCE", 0), config.get("TRIGGER_COOLDOWN", 10))
+        tasks.append(scale.dispatcher.run())
+    if publisher is not None:
+        tasks.append(publisher.run())
+    if config.get("METRICS_PORT"):
+        logger.info(f"Serving metrics on port {config['METRICS_PORT']}")
+        tasks.append(metrics.serve(config["METRICS_PORT"]))
+    await asyncio.gather(*tasks)
+
+
+class MqttPublisher:
+    # publishes the measurements queued in the outbox table (see VivaPersistence.persist_many) to MQTT_PUBLISH_TOPIC
+    # over one long-lived connection, with QoS 1 and retained, so the topic of a user always holds the latest values
+    # rows are marked delivered once the broker acknowledged them, after a broker outage they are sent again
+    # (at least once). The sync only writes the outbox and never waits for the broker.
+
+    def __init__(self):
+        self.pending = asyncio.Event()
+        # the outbox may hold measurements from before a restart
+        self.pending.set()
+
+    def request(self):
+        self.pending.set()
+
+    async def run(self):
+        from aiomqtt import Client, MqttError
+
+        while True:
+            try:
+                async with Client(config["MQTT_HOST"], port=config.get("MQTT_PORT", 1883)) as client:
+                    if config.get("MQTT_DISCOVERY", False):
+                        await self.publish_discovery(client)
+                    while True:
+                        await self.pending.wait()
+                        self.pending.clear()
+                        await self.drain(client)
+            except MqttError as e:
+                logger.error(f"MQTT publishing interrupted, retrying in {MQTT_RECONNECT_SECONDS}s: {e}")
+                self.pending.set()
+                await asyncio.sleep(MQTT_RECONNECT_SECONDS)
+
+    async def publish_once(self):
+        # drains the outbox over a new connection, for sync-once
+        from aiomqtt import Client, MqttError
+
         try:
-            async for message in client.messages:
-                logger.info(f"Got sync command via MQTT on {message.topic} with {message.payload.decode()}")                    
-                if isReading is False:
-                    logger.info("Starting sync")
-                    await sync()
-                    logger.info("Sync done")
-                else:
-                    logger.info("Sync already in progress, ignoring MQTT command")
-        except asyncio.CancelledError:
-            logger.info("MQTT listener cancelled")
+            async with Client(config["MQTT_HOST"], port=config.get("MQTT_PORT", 1883)) as client:
+                if config.get("MQTT_DISCOVERY", False):
+                    await self.publish_discovery(client)
+                await self.drain(client)
+        except MqttError as e:
+            logger.warning(f"Could not publish the new measurements, they stay queued: {e}")
+
+    async def drain(self, client):
+        persistence = VivaPersistence(db_name=DATABASE_NAME)
+        try:
+            while True:
+                batch = persistence.get_outbox(OUTBOX_BATCH_SIZE)
+                if not batch:
+                    return
+                # the publishes of a batch are in flight together, in order per user
+                await asyncio.gather(
+                    *[
+                        client.publish(state_topic(row["UserID"]), json.dumps(row), qos=1, retain=True)
+                        for rowid, row in batch
+                    ]
+                )
+                persistence.mark_delivered([rowid for rowid, row in batch])
+                metrics.count("measurements_published", len(batch))
+                logger.info(f"Published {len(batch)} measurements to MQTT")
+        finally:
+            persistence.close()
+
+    async def publish_discovery(self, client):
+        # one device per user of every scale, its sensors read the topic of the user id stored in the database
+        prefix = config.get("MQTT_DISCOVERY_PREFIX", "homeassistant")
+        for scale in scales:
+            deviceId = scale.mac.replace(":", "").lower()
+            for user in range(1, scale.users + 1):
+                userId = user + scale.user_offset
+                device = {
+                    "identifiers": [f"omviva_{deviceId}_{user}"],
+                    "name": f"Omron VIVA user {user}" if len(scales) == 1 else f"Omron VIVA {scale.name} user {user}",
+                    "manufacturer": "Omron",
+                    "model": "VIVA",
+                }
+                for column, (name, unit, deviceClass, factor) in DISCOVERY_SENSORS.items():
+                    uniqueId = f"omviva_{deviceId}_{user}_{column.lower()}"
+                    value = f"value_json.{column}" if factor == 1 else f"(value_json.{column} * {factor}) | round(1)"
+                    payload = {
+                        "name": name,
+                        "unique_id": uniqueId,
+                        "state_topic": state_topic(userId),
+                        "value_template": f"{{{{ {value} }}}}",
+                        "state_class": "measurement",
+                        "device": device,
+                    }
+                    if unit:
+                        payload["unit_of_measurement"] = unit
+                    if deviceClass:
+                        payload["device_class"] = deviceClass
+                    topic = f"{prefix}/sensor/{uniqueId}/config"
+                    await client.publish(topic, json.dumps(payload), qos=1, retain=True)
+
+
+def state_topic(user):
+    return config["MQTT_PUBLISH_TOPIC"].format(user=user)
+
+
+async def publish_metrics():
+    # retained, so the latest numbers of every unit can be read at any time
+    from aiomqtt import Client, MqttError
+
+    try:
+        async with Client(config["MQTT_HOST"], port=config.get("MQTT_PORT", 1883)) as client:
+            await client.publish(config["METRICS_MQTT_TOPIC"], json.dumps(metrics.summary()), retain=True)
+    except MqttError as e:
+        logger.warning(f"Could not publish metrics: {e}")
+
 
+def ssh_connect(hostname, username, password):
+    import paramiko
 
-def scp_transfer(local_file, remote_file, hostname, username, password):
     client = paramiko.SSHClient()
     client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
     client.connect(hostname, username=username, password=password)
+    client.get_transport().set_keepalive(SSH_KEEPALIVE_SECONDS)
+    return client
 
-    with SCPClient(client.get_transport()) as scp:
-        scp.put(local_file, remote_file)
 
-    client.close()
+def scp_snapshot(client, local_file, remote_file):
+    # copies a consistent snapshot of the database, taken with the SQLite online backup API,
+    # returns the watermark of the snapshot
+    from scp import SCPClient
+
+    snapshot = local_file + ".snapshot"
+    persistence = VivaPersistence(db_name=local_file)
+    try:
+        watermark = persistence.snapshot(snapshot)
+    finally:
+        persistence.close()
+    try:
+        with SCPClient(client.get_transport()) as scp:
+            scp.put(snapshot, remote_file)
+    finally:
+        Path(snapshot).unlink()
+    return watermark
+
+
+def scp_replicate(client, local_file, remote_path, remote):
+    # ships only the rows added since the last transfer and merges them into the remote copy
+    # the remote copy is bootstrapped with a full copy of the database
+    from scp import SCPClient
+
+    persistence = VivaPersistence(db_name=local_file)
+    try:
+        watermark = persistence.get_replication_watermark(remote)
+        if watermark is not None:
+            changeset, newWatermark = build_changeset(persistence, watermark)
+            if changeset is None:
+                logger.info("Remote database is up to date")
+                return
+            with SCPClient(client.get_transport()) as scp:
+                scp.putfo(io.BytesIO(changeset), remote_path + CHANGESET_NAME)
+            command = " ".join(
+                shlex.quote(part)
+                for part in (
+                    config.get("SCP_REMOTE_PYTHON", "python3"),
+                    remote_path + Path(omviva_replication.__file__).name,
+                    "apply",
+                    remote_path + CHANGESET_NAME,
+                    remote_path + Path(local_file).name,
+                )
+            )
+            stdin, stdout, stderr = client.exec_command(command)
+            status = stdout.channel.recv_exit_status()
+            if status == 0:
+                persistence.store_replication_watermark(remote, newWatermark)
+                logger.info(f"Sent {len(changeset)} bytes of changes to remote host: {stdout.read().decode().strip()}")
+                return
+            logger.warning(f"Applying changes on remote host failed ({status}), sending the full database")
+
+        with SCPClient(client.get_transport()) as scp:
+            scp.put(omviva_replication.__file__, remote_path + Path(omviva_replication.__file__).name)
+        newWatermark = scp_snapshot(client, local_file, remote_path + Path(local_file).name)
+        persistence.store_replication_watermark(remote, newWatermark)
+        logger.info("Database transferred to remote host")
+    finally:
+        persistence.close()
+
+
+class UploadWorker:
+    # uploads the database to SCP_HOST in a worker thread, so the event loop keeps serving triggers meanwhile
+    # upload requests arriving within UPLOAD_DELAY_SECONDS or during an upload are merged into one upload
+    # the SSH connection is kept open between uploads
+
+    def __init__(self):
+        self.pending = asyncio.Event()
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="upload")
+        self.client = None
+        self.task = None
+
+    def request(self):
+        if self.task is None:
+            self.task = asyncio.ensure_future(self.run())
+        self.pending.set()
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await self.pending.wait()
+            await asyncio.sleep(UPLOAD_DELAY_SECONDS)
+            self.pending.clear()
+            try:
+                with metrics.span("upload"):
+                    await loop.run_in_executor(self.executor, self.upload)
+            except Exception as e:
+                metrics.count("upload_failures")
+                logger.error(f"Error transferring database: {e}")
+                await loop.run_in_executor(self.executor, self.disconnect)
+
+    def upload(self):
+        if self.client is None or not self.client.get_transport() or not self.client.get_transport().is_active():
+            self.disconnect()
+            self.client = ssh_connect(config["SCP_HOST"], config["SCP_USER"], config["SCP_PASSWORD"])
+
+        if config.get("SCP_MODE", "full") == "delta":
+            remote = f"{config['SCP_USER']}@{config['SCP_HOST']}:{config['SCP_PATH']}"
+            scp_replicate(self.client, DATABASE_NAME, config["SCP_PATH"], remote)
+        else:
+            scp_snapshot(self.client, DATABASE_NAME, config["SCP_PATH"] + DATABASE_NAME)
+            logger.info("Database transferred to remote host")
+
+    def disconnect(self):
+        if self.client is not None:
+            self.client.close()
+            self.client = None
+
+    async def flush(self):
+        # runs a requested upload right away and closes the connection, for sync-once
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+        if not self.pending.is_set():
+            return
+        self.pending.clear()
+        loop = asyncio.get_running_loop()
+        try:
+            with metrics.span("upload"):
+                await loop.run_in_executor(self.executor, self.upload)
+        except Exception as e:
+            metrics.count("upload_failures")
+            logger.error(f"Error transferring database: {e}")
+        finally:
+            await loop.run_in_executor(self.executor, self.disconnect)
 
 
 def getConfig():
@@ -72,72 +539,235 @@ def getConfig():
         return config
 
 
-async def sync():
-    global isReading
-    isReading = True
-    success = False
-    attempts = 0
-    while not success:
-        attempts += 1
-        viva = OmronBLE(logger=logger, bleAddr=config["VIVA_MAC"])
-        persistence = VivaPersistence(db_name=DATABASE_NAME)
+def failure_kind(e):
+    # the key of RETRY_BACKOFF for an exception raised by a sync attempt
+    from bleak.exc import BleakDeviceNotFoundError
+    from omviva_comms import OmronPairingError
 
-        # we don't know for which user the transmission should be started
-        # also we cannot read all users in one connect cycle
-        # so the idea is to cycle between users
-        noOfUsers = config["NO_OF_USERS"]
-        last_user = persistence.get_last_sync_user()
-        if last_user[0]:
-            last_sync_time = datetime.fromtimestamp(last_user[0]).strftime("%Y-%m-%d %H:%M:%S")
-            user = last_user[1] + 1
-            if user > noOfUsers:
-                user = 1
-            logger.info(f"Last user was #{last_user[1]} on {last_sync_time}. Next user is #{user}")
-        else:
-            user = 1
-            logger.info(f"First sync, starting with user #{user}")
+    if isinstance(e, BleakDeviceNotFoundError):
+        return "not_found"
+    if isinstance(e, OmronPairingError):
+        return "pairing"
+    if isinstance(e, asyncio.TimeoutError):
+        return "timeout"
+    return "other"
 
-        lastSeq = persistence.get_highest_sequence_number_for_user(user)
-        if lastSeq is None:
-            lastSeq = 0
-        logger.info(f"Last sequence for user #{user} was {lastSeq}")
 
-        try:
-            await asyncio.sleep(2)
-            await viva.connect()
-            logger.info(f"Syncing user #{user}")
-            allRecs = await viva.get_records(user, lastSeq + 1)
-            for rec in allRecs:
-                persistence.persist_measurement(rec)
-
-            logger.info(f"Syncing done for user #{user}")
-            persistence.store_success(user)
-            await viva.disconnect()
-            success = True
-            persistence.close()
-            if config["SCP_HOST"]:
-                scp_transfer(
-                    DATABASE_NAME,
-                    config["SCP_PATH"] + DATABASE_NAME,
-                    config["SCP_HOST"],
-                    config["SCP_USER"],
-                    config["SCP_PASSWORD"],
-                )
-                logger.info("Database transferred to remote host")
-            break
-        except Exception as e:
-            logger.error(f"Error syncing (attempt {attempts}): {e}")
-        finally:
-            persistence.close()
+def retry_delay(kind, streak):
+    # seconds to wait after the streak-th failure of that kind in a row
+    first, maximum = RETRY_BACKOFF[kind]
+    return min(first * 2 ** (streak - 1), maximum)
+
 
-        if attempts > 3:
-            logger.error("Max attempts reached, aborting sync")
-            break
-    isReading = False
-    await mqtt_listener()
+async def sync(scale):
+    from omviva_comms import OmronResponseError
+
+    if scale.breaker.is_open():
+        metrics.count("breaker_skips")
+        logger.warning(f"Skipping sync of {scale.name}, it was not found in the last {scale.breaker.failures} attempts")
+        return
+    scale.reading = True
+    try:
+        # failed attempts in a row without new records, and the kind and streak of the last failures
+        failures = 0
+        lastKind = None
+        streak = 0
+        # user whose transfer was interrupted, the next attempt resumes it first
+        resumeUser = None
+        maxAttempts = config.get("SYNC_ATTEMPTS", SYNC_ATTEMPTS)
+        # one OmronBLE for all attempts and syncs, so the BLE client and its cached state are reused
+        if scale.viva is None:
+            scale.viva = create_omron_ble(scale)
+        viva = scale.viva
+        offset = scale.user_offset
+        while True:
+            if lastKind is not None:
+                delay = retry_delay(lastKind, streak)
+                logger.info(f"Retrying the sync of {scale.name} in {delay}s")
+                metrics.count("sync_retries")
+                await asyncio.sleep(delay)
+            # the adapter slot is taken per attempt, so the other scales of the adapter and its passive scanner
+            # (which can close the breaker, see bl_passive_scan_callback) are not blocked during the retry delay
+            async with scale.adapter.connection():
+                persistence = writer
+                if persistence is None:
+                    persistence = VivaPersistence(db_name=DATABASE_NAME, outbox=publisher is not None)
+
+                # every notification is archived, so the records can be decoded again later (see reprocess)
+                def archive(timestamp, channel, data):
+                    persistence.archive_notification(timestamp, channel, data, device=scale.mac)
+
+                viva.notification_sink = archive
+
+                # we don't know for which user the transmission should be started
+                # also we cannot read all users in one connect cycle
+                # so the scale is asked for the number of new records of each user, most promising user first,
+                # and the first user with new records is transferred
+                states = persistence.get_user_states()
+                users = order_users(states, scale.users, offset)
+                if resumeUser is not None:
+                    users.remove(resumeUser)
+                    users.insert(0, resumeUser)
+                logger.info(f"Checking users of {scale.name} in order {users}")
+
+                # user being transferred and its checkpoint when the transfer started
+                transferUser = None
+                transferStart = None
+                try:
+                    await viva.connect()
+                    synced_user = None
+                    for user in users:
+                        lastSeq = persistence.get_checkpoint(user + offset)
+                        try:
+                            count = await viva.get_record_count(user, lastSeq + 1)
+                        except (OmronResponseError, asyncio.TimeoutError) as e:
+                            if user == users[0]:
+                                raise
+                            logger.warning(f"Could not switch to user #{user}, continuing with the next sync: {e}")
+                            break
+                        persistence.store_user_count(user + offset, count, lastSeq)
+                        if count == 0:
+                            logger.info(f"No new records for user #{user} after sequence {lastSeq}")
+                            continue
+
+                        lastSync = states.get(user + offset, (None, None, None, None))[2]
+                        if user == resumeUser:
+                            logger.info(f"Resuming user #{user} after sequence {lastSeq}, {count} records left")
+                        elif lastSync:
+                            lastSyncTime = datetime.fromtimestamp(lastSync).strftime("%Y-%m-%d %H:%M:%S")
+                            logger.info(f"Syncing user #{user}, last synced on {lastSyncTime}")
+                        else:
+                            logger.info(f"Syncing user #{user}")
+                        transferUser = user
+                        transferStart = lastSeq
+                        inserted, skipped = await store_records(viva.stream_records(lastSeq + 1), persistence, offset)
+                        logger.info(f"Stored {inserted} new records for user #{user}, {skipped} already known")
+
+                        logger.info(f"Syncing done for user #{user}")
+                        persistence.store_success(user + offset)
+                        synced_user = user
+                        break
+
+                    if synced_user is None:
+                        logger.info("No new records for any user")
+                    await viva.disconnect()
+                    scale.breaker.record(None)
+                    persistence.flush_notifications()
+                    if config["SCP_HOST"] and synced_user is not None:
+                        uploader.request()
+                    break
+                except Exception as e:
+                    kind = failure_kind(e)
+                    metrics.count("sync_errors")
+                    metrics.count(f"sync_errors_{kind}")
+                    logger.error(f"Error syncing {scale.name} ({kind}, attempt {failures + 1}): {e}")
+                    streak = streak + 1 if kind == lastKind else 1
+                    lastKind = kind
+                    failures += 1
+                    resumeUser = None
+                    if transferUser is not None:
+                        # the batches committed before the failure are kept, the next attempt continues after them
+                        checkpoint = persistence.get_checkpoint(transferUser + offset)
+                        if checkpoint > transferStart:
+                            logger.info(f"Checkpoint of user #{transferUser} moved to sequence {checkpoint}")
+                            resumeUser = transferUser
+                            failures = 0
+                            streak = 1
+                    await release(viva)
+                    if scale.breaker.record(kind):
+                        metrics.count("breaker_trips")
+                        logger.error(f"{scale.name} was not found {scale.breaker.failures} times, pausing its syncs")
+                        break
+                    if failures >= maxAttempts:
+                        logger.error("Max attempts reached, aborting sync")
+                        break
+                finally:
+                    viva.notification_sink = None
+                    if persistence is writer:
+                        persistence.flush_notifications()
+                    else:
+                        persistence.close()
+                    if publisher is not None:
+                        # also after a failed attempt, for the batches stored before it failed
+                        publisher.request()
+    finally:
+        # also when an attempt could not even start, the passive scan ignores the scale while it is set
+        scale.reading = False
+
+
+async def release(viva):
+    # drops the connection after a failed attempt, so the next attempt starts a new session with the scale
+    if viva.ble_client is None:
+        return
+    try:
+        await viva.disconnect()
+    except Exception as e:
+        logger.debug(f"Disconnect after the failed attempt failed: {e}")
 
-async def pair(user):
-    viva = OmronBLE(logger=logger, bleAddr=config["VIVA_MAC"])
+
+async def store_records(records, persistence, userOffset=0):
+    # persists the records in small transactions while they arrive, so a dropped connection
+    # only loses the records that were not received yet
+    inserted = skipped = 0
+    batch = []
+    try:
+        async for rec in records:
+            rec.mUserID += userOffset
+            batch.append(rec)
+            if len(batch) >= PERSIST_BATCH_SIZE:
+                batchInserted, batchSkipped = persistence.persist_many(batch)
+                inserted += batchInserted
+                skipped += batchSkipped
+                batch = []
+    finally:
+        if batch:
+            batchInserted, batchSkipped = persistence.persist_many(batch)
+            inserted += batchInserted
+            skipped += batchSkipped
+    return inserted, skipped
+
+
+def reprocess():
+    from omviva_profile import load_features
+
+    persistence = VivaPersistence(db_name=DATABASE_NAME)
+    try:
+        start = time.perf_counter()
+        stored, failed = persistence.reprocess(
+            features=load_features(Path(__file__).parent / DEVICE_CACHE_NAME),
+            user_offsets={scale.mac: scale.user_offset for scale in scales},
+        )
+        duration = time.perf_counter() - start
+        logger.info(f"Reprocessed {stored} records in {duration:.2f}s, {failed} could not be decoded")
+    finally:
+        persistence.close()
+
+
+def order_users(states, noOfUsers, userOffset=0):
+    # users that still had records pending at their last check come first,
+    # then the users that have not been checked for the longest time
+    def priority(user):
+        lastCount, lastSequence, lastSync, lastCheck = states.get(user + userOffset, (None, None, None, None))
+        return (not lastCount, lastCheck or 0)
+
+    return sorted(range(1, noOfUsers + 1), key=priority)
+
+
+def create_omron_ble(scale):
+    from omviva_comms import OmronBLE
+
+    return OmronBLE(
+        logger=logger,
+        bleAddr=scale.mac,
+        adapter=scale.adapter.name,
+        keep_bond=config.get("KEEP_BOND", False),
+        cache_file=Path(__file__).parent / DEVICE_CACHE_NAME,
+        client_factory=ble_client_factory,
+    )
+
+
+async def pair(scale, user):
+    viva = create_omron_ble(scale)
 
     try:
         await viva.connect()
@@ -147,11 +777,13 @@ async def pair(user):
         logger.error(f"Pair Error: {e}")
 
 
-async def bl_passive_scan_callback(device: BLEDevice, advertisement_data: AdvertisementData):
-    if device.address == config["VIVA_MAC"] and isReading is False:
-        logger.info(f"I found {device.name} via passive scan")
-        await scanner.stop()
-        await sync()
+async def bl_passive_scan_callback(device: "BLEDevice", advertisement_data: "AdvertisementData"):
+    for scale in scales:
+        if device.address == scale.mac and scale.reading is False:
+            logger.debug(f"I found {device.name} ({scale.name}) via passive scan")
+            # the scale is in range again
+            scale.breaker.reset()
+            scale.dispatcher.trigger("passive scan")
 
 
 async def bl_passive_scan():
@@ -159,47 +791,146 @@ async def bl_passive_scan():
     # flag --experimental is needed
     # BlueZ >= 5.56
     # Linux kernel >= 5.10.
+    # every adapter has a scanner, it keeps running (only paused during syncs), detections are handed to the
+    # dispatcher of the scale
+    from bleak import BleakScanner
+    from bleak.assigned_numbers import AdvertisementDataType
+    from bleak.backends.bluezdbus.advertisement_monitor import OrPattern
+    from bleak.backends.bluezdbus.scanner import BlueZScannerArgs
+
+    adapters = {scale.adapter.name: scale.adapter for scale in scales}
+    for adapter in adapters.values():
+        kwargs = {} if adapter.name is None else {"adapter": adapter.name}
+        adapter.scanner = BleakScanner(
+            bl_passive_scan_callback,
+            None,
+            scanning_mode="passive",
+            bluez=BlueZScannerArgs(
+                or_patterns=[
+                    OrPattern(0, AdvertisementDataType.FLAGS, b"\x06"),
+                ]
+            ),
+            **kwargs,
+        )
+        await adapter.scanner.start()
+    try:
+        await asyncio.Event().wait()
+    finally:
+        for adapter in adapters.values():
+            if adapter.scanner is not None:
+                await adapter.scanner.stop()
 
-    global scanner
-    scanner = BleakScanner(
-        bl_passive_scan_callback,
-        None,
-        scanning_mode="passive",
-        bluez=BlueZScannerArgs(
-            or_patterns=[
-                OrPattern(0, AdvertisementDataType.FLAGS, b"\x06"),
-            ]
-        ),
-    )
-
-    while True:
-        if isReading is False:
-            await scanner.start()
-            await asyncio.sleep(10.0)
-            await scanner.stop()
-        else:
-            logger.info("Waiting for sync to finish before scanning again")
-            await asyncio.sleep(60.0)
 
+def setup():
+    # config, logging and the objects needed to talk to the scales, for the commands that do
+    global config, logger, scales, uploader, publisher
+    from malog import setupLogging
 
-if __name__ == "__main__":
     config = getConfig()
-
     logger = setupLogging(config)
     logger.info("Omron VIVA Sync Tool started")
+    scales = get_scales(config)
+    uploader = UploadWorker()
+    if config.get("MQTT_PUBLISH_TOPIC"):
+        publisher = MqttPublisher()
+
+
+async def sync_once(selected):
+    # syncs the scales once (at the same time, within the adapter limits), then publishes and uploads right away
+    global writer
+    writer = VivaPersistence(db_name=DATABASE_NAME, outbox=publisher is not None)
+
+    try:
+        await asyncio.gather(*[sync(scale) for scale in selected])
+    finally:
+        writer.close()
+        writer = None
+    if publisher is not None:
+        await publisher.publish_once()
+    await uploader.flush()
+
+
+def decode(args):
+    # prints the records in a dump of measurement notifications (hex on the command line or in a file, or binary)
+    from omviva_measurement import OmronMeasurementWS, frame_packets
+
+    if args.file:
+        data = Path(args.file).read_bytes()
+        try:
+            data = bytes.fromhex(data.decode("ascii"))
+        except (UnicodeDecodeError, ValueError):
+            pass
+    else:
+        data = bytes.fromhex("".join(args.hex))
+    # framed like the notifications of a sync, the records end at padding or an unknown packet
+    end = 0
+    for data1, data2 in frame_packets([data]):
+        end += len(data1) + (len(data2) if data2 is not None else 0)
+        print(OmronMeasurementWS(data1=data1, data2=data2))
+    if end < len(data):
+        print(f"{len(data) - end} trailing bytes not decoded", file=sys.stderr)
 
-    parser = argparse.ArgumentParser(description="Omron VIVA Sync Tool")
-    parser.add_argument("-pair", type=int, help="Pair with a new user")
-    args = parser.parse_args()
 
-    if args.pair:
-        logger.info(f"Pairing with user #{args.pair}")
-        asyncio.run(pair(args.pair))
-        sys.exit(0)
+# old style options, mapped to the commands
+LEGACY_OPTIONS = {"-pair": "pair", "-reprocess": "reprocess"}
 
-    if config["TRIGGER_MODE"] == "mqtt":
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Omron VIVA Sync Tool")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run = commands.add_parser("run", help="wait for triggers and sync (default)")
+    run.add_argument("--trigger", choices=("mqtt", "bt"), help="trigger mode (default: TRIGGER_MODE)")
+    once = commands.add_parser("sync-once", help="sync once and exit")
+    once.add_argument("--device", action="append", help="name or MAC of a scale (default: all)")
+    pairing = commands.add_parser("pair", help="pair with a new user")
+    pairing.add_argument("user", type=int)
+    pairing.add_argument("--device", "-device", help="name or MAC of the scale (default: the first one)")
+    commands.add_parser("reprocess", help="decode all archived notifications again")
+    decoding = commands.add_parser("decode", help="decode a dump of measurement notifications")
+    decoding.add_argument("hex", nargs="*", help="notifications as hex")
+    decoding.add_argument("--file", help="file with the notifications (hex or binary)")
+    # export and bench have their own options
+    commands.add_parser("export", help="export the measurements, see omviva_export.py", add_help=False)
+    commands.add_parser("bench", help="benchmark against a simulated scale, see omviva_bench.py", add_help=False)
+
+    if not argv:
+        argv = ["run"]
+    elif argv[0] in LEGACY_OPTIONS:
+        argv = [LEGACY_OPTIONS[argv[0]]] + argv[1:]
+    if argv[0] in ("export", "bench"):
+        args, rest = parser.parse_known_args(argv[:1])[0], argv[1:]
+    else:
+        args = parser.parse_args(argv)
+
+    if args.command == "export":
+        import omviva_export
+
+        return omviva_export.main(rest)
+    if args.command == "bench":
+        import omviva_bench
+
+        return omviva_bench.main(rest)
+    if args.command == "decode":
+        return decode(args)
+
+    setup()
+    if args.command == "pair":
+        scale = get_scale(args.device)
+        logger.info(f"Pairing {scale.name} with user #{args.user}")
+        asyncio.run(pair(scale, args.user))
+    elif args.command == "reprocess":
+        reprocess()
+    elif args.command == "sync-once":
+        selected = [get_scale(name) for name in args.device] if args.device else scales
+        asyncio.run(sync_once(selected))
+    elif (args.trigger or ("mqtt" if config["TRIGGER_MODE"] == "mqtt" else "bt")) == "mqtt":
         logger.info("Using MQTT trigger mode")
-        asyncio.run(mqtt_listener())
+        asyncio.run(run_service(mqtt_listener))
     else:
         logger.info("Using BL passive scan trigger mode")
-        asyncio.run(bl_passive_scan())
+        asyncio.run(run_service(bl_passive_scan))
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
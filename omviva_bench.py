@@ -0,0 +1,99 @@
+# end-to-end sync benchmark against the simulated scale in omviva_sim.py
+#
+#   python3 omviva_bench.py --users 1 2 3 4 --backlog 1 10 30 --response-delay 0.05 --packet-delay 0.01
+#
+# For every combination of users and backlog a fresh database is synced until all records of all users are
+# stored. Reports the wall-clock time per sync, the time spent per phase and the records stored per second.
+
+import argparse
+import asyncio
+import logging
+import sqlite3
+import tempfile
+import time
+from pathlib import Path
+
+import omviva
+from omviva_metrics import metrics
+from omviva_sim import FakeScale, SCALE_MEMORY_RECORDS
+
+PHASES = ("connect", "setup", "query", "transfer", "finish")
+
+
+async def run_case(users, backlog, args, directory):
+    scale = FakeScale(
+        {user: backlog for user in range(1, users + 1)},
+        response_delay=args.response_delay,
+        packet_delay=args.packet_delay,
+        drop_after=args.drop_after,
+    )
+    omviva.config = {"VIVA_MAC": "00:00:00:00:00:00", "NO_OF_USERS": users, "SCP_HOST": ""}
+    omviva.DATABASE_NAME = str(directory / f"bench_{users}_{backlog}.db")
+    omviva.DEVICE_CACHE_NAME = str(directory / f"bench_{users}_{backlog}.json")
+    omviva.ble_client_factory = scale.client_factory
+    viva = omviva.get_scales(omviva.config)[0]
+
+    durations = []
+    phases = {phase: 0.0 for phase in PHASES}
+    start = time.perf_counter()
+    # one user is transferred per sync
+    for _ in range(users):
+        syncStart = time.perf_counter()
+        await omviva.sync(viva)
+        durations.append(time.perf_counter() - syncStart)
+        for phase, seconds in scale.phases().items():
+            phases[phase] += seconds
+    total = time.perf_counter() - start
+
+    conn = sqlite3.connect(omviva.DATABASE_NAME)
+    stored = conn.execute("SELECT COUNT(*) FROM measurements").fetchone()[0]
+    conn.close()
+    return {
+        "users": users,
+        "backlog": backlog,
+        "stored": stored,
+        "expected": users * backlog,
+        "total": total,
+        "sync": sum(durations) / len(durations),
+        "worst": max(durations),
+        "phases": {phase: seconds / len(durations) for phase, seconds in phases.items()},
+        "rate": stored / total if total else 0.0,
+    }
+
+
+def print_result(result):
+    phases = " ".join(f"{phase}={seconds:.3f}" for phase, seconds in result["phases"].items())
+    status = "" if result["stored"] == result["expected"] else f" MISSING {result['expected'] - result['stored']}"
+    print(
+        f"users={result['users']} backlog={result['backlog']:3} stored={result['stored']:4} "
+        f"total={result['total']:.3f}s sync={result['sync']:.3f}s worst={result['worst']:.3f}s "
+        f"{phases} rate={result['rate']:.1f} rec/s{status}"
+    )
+
+
+async def run(args):
+    with tempfile.TemporaryDirectory() as directory:
+        for users in args.users:
+            for backlog in args.backlog:
+                print_result(await run_case(users, backlog, args, Path(directory)))
+    if args.metrics:
+        print(metrics.render(), end="")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Omron VIVA sync benchmark against a simulated scale")
+    parser.add_argument("--users", type=int, nargs="+", default=[1, 2, 3, 4])
+    parser.add_argument("--backlog", type=int, nargs="+", default=[1, 10, SCALE_MEMORY_RECORDS])
+    parser.add_argument("--response-delay", type=float, default=0.05, help="seconds until the scale answers")
+    parser.add_argument("--packet-delay", type=float, default=0.01, help="seconds between notifications")
+    parser.add_argument("--drop-after", type=int, default=None, help="drop the link once after N notifications")
+    parser.add_argument("--metrics", action="store_true", help="print the collected metrics at the end")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.WARNING)
+    omviva.logger = logging.getLogger("omviva_bench")
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
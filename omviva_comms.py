@@ -1,13 +1,18 @@
 import asyncio
-from omviva_measurement import OmronMeasurementWS
-from bleak.exc import BleakDeviceNotFoundError
+import json
+import time
+from pathlib import Path
+from omviva_measurement import OmronMeasurementWS, FrameAssembler
+from omviva_metrics import metrics
+from omviva_profile import DeviceProfile, FIRMWARE_REVISION_UUID, BODY_COMPOSITION_FEATURE_UUID, UNKNOWN_FIRMWARE
+from bleak.exc import BleakDeviceNotFoundError, BleakError
 import bleak
 
 
 class OmronBLE:
     RECORD_ACCESS_CONTROL_POINT = "00002a52-0000-1000-8000-00805f9b34fb"
     USER_CONTROL_POINT = "00002a9f-0000-1000-8000-00805f9b34fb"
-    OMRON_MEASUREMENT_WS = "8ff2ddfb-4a52-4ce5-85a4-d2f97917792a"
+    OMRON_MEASUREMENT_WS = OmronMeasurementWS.CHARACTERISTIC_UUID
 
     DEVICE_RX_CHANNEL_UUIDS = [
         # "00002a2b-0000-1000-8000-00805f9b34fb",  # Current Time Handle: 1296  510
@@ -18,23 +23,76 @@ class OmronBLE:
     ]
 
     # DEVICE_DATA_RX_CHANNEL_INT_HANDLES = [0x510, 0x730, 0x710, 0x610, 0x620]
+    # handles of the known firmware, used until the profile of the device is loaded
     DEVICE_DATA_RX_CHANNEL_INT_HANDLES = [0x730, 0x610, 0x620]
 
-    def __init__(self, bleAddr, logger, pairing=False):
-        self.rx_raw_channel_buffer = [None] * 5  # a buffer for each channel
+    # seconds to wait for the response to a control point request
+    RESPONSE_TIMEOUT = 10
+    # seconds to wait for the end of a record transfer
+    TRANSFER_TIMEOUT = 60
+    # seconds to wait for an answer to the final 1000 request
+    FINISH_TIMEOUT = 3
+
+    def __init__(
+        self, bleAddr, logger, pairing=False, keep_bond=False, cache_file=None, client_factory=None, adapter=None
+    ):
         self.bleAddr = bleAddr
+        # Bluetooth adapter (e.g. "hci1"), None for the default one
+        self.adapter = adapter
         self.logger = logger
+        # with keep_bond the bond and the GATT service map (in cache_file) are kept between connects
+        self.keep_bond = keep_bond
+        self.cache_file = cache_file
+        self.bond_checked = False
         self.current_rx_notify_state_flag = False
+        # creates the BleakClient, replaced by omviva_sim for the simulated scale
+        self.client_factory = client_factory or bleak.BleakClient
         self.ble_client = None
+        self.number_of_records = None
+        # (control point uuid, request opcode) -> future resolved by _callback_for_rx_channels
+        self.pending_responses = {}
+        # record framing on the measurement channel, see _frame_record_packet
+        self.records_received = 0
+        self.records_expected = None
+        self.records_complete = None
+        self.assembler = FrameAssembler()
+        # (data1, data2) of complete records while stream_records is running
+        self.record_queue = None
+        # called with (time, channel uuid, bytes) for every notification, see VivaPersistence.archive_notification
+        self.notification_sink = None
+        # DeviceProfile of the connected firmware, read once by connect (see omviva_profile.py)
+        self.profile = None
+        # BodyCompositionFeature of the profile, None for the default resolutions
+        self.feature = None
+        # handle -> index in DEVICE_RX_CHANNEL_UUIDS, replaced by the table of the profile
+        self.channels = dict(zip(self.DEVICE_DATA_RX_CHANNEL_INT_HANDLES, range(len(self.DEVICE_RX_CHANNEL_UUIDS))))
 
     async def connect(self):
-        self.ble_client = bleak.BleakClient(self.bleAddr, timeout=10)
+        device = self._load_device_cache()
+        if self.ble_client is None:
+            # with a known service map only the services we use are discovered
+            kwargs = {} if self.adapter is None else {"adapter": self.adapter}
+            self.ble_client = self.client_factory(
+                self.bleAddr,
+                timeout=10,
+                services=device.get("services") if self.keep_bond else None,
+                disconnected_callback=self._on_disconnect,
+                **kwargs,
+            )
+        self.current_rx_notify_state_flag = False
+        self.bond_checked = False
         try:
             self.logger.info(f"Attempt connecting to {self.bleAddr}.")
-            await self.ble_client.connect()
-            await asyncio.sleep(1)
-            await self.ble_client.pair(protection_level=2)
-            self.logger.info("pair done")
+            with metrics.span("connect"):
+                await self.ble_client.connect()
+            if self.keep_bond and device.get("bonded"):
+                self.logger.info("Reusing existing bond")
+            else:
+                await self._pair()
+            if self.keep_bond and "services" not in device:
+                self._store_service_map()
+            if self.profile is None:
+                await self._load_profile(device)
         except BleakDeviceNotFoundError as e:
             # self.logger.error(f"Device not found. {e}")
             raise e
@@ -42,22 +100,140 @@ class OmronBLE:
             # self.logger.error(f"Something else {e}")
             raise e
 
-    async def disconnect(self):
-        if self.ble_client.is_connected:
+    def _on_disconnect(self, client):
+        # fail the running exchange right away instead of waiting for its timeout
+        for future in self.pending_responses.values():
+            if not future.done():
+                future.set_exception(BleakError("Disconnected during exchange"))
+        self.pending_responses.clear()
+
+    async def _pair(self):
+        with metrics.span("pair"):
+            await asyncio.sleep(1)
+            try:
+                await self.ble_client.pair(protection_level=2)
+            except (BleakError, asyncio.TimeoutError) as e:
+                raise OmronPairingError(f"Pairing with {self.bleAddr} failed: {e}") from e
+        self.logger.info("pair done")
+        self.bond_checked = True
+        if self.keep_bond:
+            self._update_device_cache(bonded=True)
+
+    async def _renew_bond(self):
+        # the scale rejected the stored bond (e.g. after a reset), remove it and pair again
+        metrics.count("bond_renewals")
+        self._update_device_cache(bonded=False)
+        try:
             await self.ble_client.unpair()
+        except BleakError as e:
+            self.logger.debug(f"unpair failed: {e}")
+        if not self.ble_client.is_connected:
+            await self.ble_client.connect()
+        await self._pair()
+
+    async def _load_profile(self, device):
+        # the firmware revision selects the cached profile, the feature and the handles are only read for a new one
+        with metrics.span("profile"):
             try:
-                await self.ble_client.disconnect()
-            except AssertionError as e:
-                self.logger.warn(f"Bleak AssertionError during disconnect. {e}")
+                firmware = await self._read_characteristic(FIRMWARE_REVISION_UUID)
+                firmware = firmware.decode("utf-8", "replace").strip("\x00 ") if firmware else UNKNOWN_FIRMWARE
+                cached = device.get("profiles", {}).get(firmware)
+                if cached is not None:
+                    profile = DeviceProfile.from_json(firmware, cached)
+                else:
+                    feature = await self._read_characteristic(BODY_COMPOSITION_FEATURE_UUID)
+                    feature = int.from_bytes(feature[:4], byteorder="little") if feature else None
+                    profile = DeviceProfile(firmware, feature, self._discover_handles())
+                    self.logger.info(f"New profile for firmware {firmware}: {profile.body_composition_feature}")
+                    self._update_device_cache(profiles={**device.get("profiles", {}), firmware: profile.to_json()})
+                if device.get("firmware") != firmware:
+                    self._update_device_cache(firmware=firmware)
+            except BleakError as e:
+                # not cached, the next connect tries again
+                self.logger.warning(f"Could not read the device profile, using the default resolutions: {e}")
+                profile = DeviceProfile(UNKNOWN_FIRMWARE, None, self._discover_handles())
+        self.profile = profile
+        self.feature = profile.body_composition_feature
+        self.channels = profile.dispatch_table(self.DEVICE_RX_CHANNEL_UUIDS)
+
+    async def _read_characteristic(self, uuid):
+        # None if the device does not have the characteristic
+        if self.ble_client.services.get_characteristic(uuid) is None:
+            return None
+        return bytes(await self.ble_client.read_gatt_char(uuid))
+
+    def _discover_handles(self):
+        handles = {}
+        for rx_channel_uuid in self.DEVICE_RX_CHANNEL_UUIDS:
+            characteristic = self.ble_client.services.get_characteristic(rx_channel_uuid)
+            if characteristic is not None:
+                handles[rx_channel_uuid] = characteristic.handle
+        return handles
+
+    def _resolve_channel(self, bleak_gatt_char, handle):
+        # a handle missing in the profile (e.g. changed by a firmware update), found by its uuid and remembered
+        uuid = getattr(bleak_gatt_char, "uuid", None)
+        if uuid in self.DEVICE_RX_CHANNEL_UUIDS:
+            self.channels[handle] = self.DEVICE_RX_CHANNEL_UUIDS.index(uuid)
+            return self.channels[handle]
+        self.logger.warning(f"Notification from unknown handle {handle} ignored")
+        return None
+
+    def _load_device_cache(self):
+        if self.cache_file is None or not Path(self.cache_file).exists():
+            return {}
+        with open(self.cache_file, "r") as cache:
+            return json.load(cache).get(self.bleAddr, {})
+
+    def _update_device_cache(self, **values):
+        if self.cache_file is None:
+            return
+        devices = {}
+        if Path(self.cache_file).exists():
+            with open(self.cache_file, "r") as cache:
+                devices = json.load(cache)
+        devices.setdefault(self.bleAddr, {}).update(values)
+        with open(self.cache_file, "w") as cache:
+            json.dump(devices, cache, indent=4)
+
+    def _store_service_map(self):
+        services = set()
+        for uuid in self.DEVICE_RX_CHANNEL_UUIDS + [FIRMWARE_REVISION_UUID, BODY_COMPOSITION_FEATURE_UUID]:
+            characteristic = self.ble_client.services.get_characteristic(uuid)
+            if characteristic is not None:
+                services.add(characteristic.service_uuid)
+        self._update_device_cache(services=sorted(services))
+
+    async def disconnect(self):
+        if self.ble_client.is_connected:
+            with metrics.span("disconnect"):
+                if not self.keep_bond:
+                    await self.ble_client.unpair()
+                try:
+                    await self.ble_client.disconnect()
+                except AssertionError as e:
+                    self.logger.warn(f"Bleak AssertionError during disconnect. {e}")
 
     async def _enable_rx_channel_notify_and_callback(self):
-        await asyncio.sleep(5)
         if not self.current_rx_notify_state_flag:
-            for rx_channel_uuid in self.DEVICE_RX_CHANNEL_UUIDS:
-                self.logger.debug(f"start_notify for {rx_channel_uuid}")
-                await self.ble_client.start_notify(rx_channel_uuid, self._callback_for_rx_channels)
+            with metrics.span("notify"):
+                try:
+                    await self._start_notify()
+                except BleakError as e:
+                    # the first access to the protected characteristics shows whether a stored bond is still accepted
+                    if self.bond_checked:
+                        raise
+                    self.logger.warning(f"Stored bond rejected, pairing again: {e}")
+                    await self._renew_bond()
+                    await self._start_notify()
+            self.bond_checked = True
             self.current_rx_notify_state_flag = True
 
+    async def _start_notify(self):
+        for rx_channel_uuid in self.DEVICE_RX_CHANNEL_UUIDS:
+            self.logger.debug(f"start_notify for {rx_channel_uuid}")
+            await self.ble_client.start_notify(rx_channel_uuid, self._callback_for_rx_channels)
+
     async def _disable_rx_channel_notify_and_callback(self):
         if self.current_rx_notify_state_flag:
             for rx_channel_uuid in self.DEVICE_RX_CHANNEL_UUIDS:
@@ -65,21 +241,57 @@ class OmronBLE:
             self.current_rx_notify_state_flag = False
 
     def _callback_for_rx_channels(self, bleak_gatt_char, rx_bytes):
-        if isinstance(bleak_gatt_char, int):
-            rx_channel_id = self.DEVICE_DATA_RX_CHANNEL_INT_HANDLES.index(bleak_gatt_char)
-        else:
-            rx_channel_id = self.DEVICE_DATA_RX_CHANNEL_INT_HANDLES.index(bleak_gatt_char.handle)
+        handle = bleak_gatt_char if isinstance(bleak_gatt_char, int) else bleak_gatt_char.handle
+        rx_channel_id = self.channels.get(handle)
+        if rx_channel_id is None:
+            rx_channel_id = self._resolve_channel(bleak_gatt_char, handle)
+            if rx_channel_id is None:
+                return
+        rx_channel_uuid = self.DEVICE_RX_CHANNEL_UUIDS[rx_channel_id]
+        metrics.count("notifications")
+        metrics.count("bytes_received", len(rx_bytes))
+        # the only copy of the notification, the archive and the records share it
+        data = bytes(rx_bytes)
+        if self.notification_sink is not None:
+            self.notification_sink(time.time(), rx_channel_uuid, data)
 
         self.logger.debug(f"rx ch{rx_channel_id} {bleak_gatt_char} < {convert_byte_array_to_hex_string(rx_bytes)}")
-        if self.rx_raw_channel_buffer[rx_channel_id] is None:
-            self.rx_raw_channel_buffer[rx_channel_id] = rx_bytes
-        else:
-            self.rx_raw_channel_buffer[rx_channel_id] += rx_bytes
+        if rx_channel_uuid == self.OMRON_MEASUREMENT_WS:
+            # measurements are handed on record by record instead of being buffered
+            self._frame_record_packet(data)
+            return
 
-        if bleak_gatt_char.uuid == self.RECORD_ACCESS_CONTROL_POINT:
+        if rx_channel_uuid == self.RECORD_ACCESS_CONTROL_POINT:
             if rx_bytes[0] == 0x05:
-                raw_value = int.from_bytes(rx_bytes[2:3], byteorder="little")
+                raw_value = int.from_bytes(rx_bytes[2:4], byteorder="little")
                 self.logger.info(f"NumberOfStoredRecordsResponse: {raw_value}")
+                self.number_of_records = raw_value
+                self._resolve_response(rx_channel_uuid, 0x04, rx_bytes)
+            elif rx_bytes[0] == 0x06 and len(rx_bytes) >= 4:
+                # ResponseCode: operator, request opcode, response value
+                self._resolve_response(rx_channel_uuid, rx_bytes[2], rx_bytes)
+        elif rx_channel_uuid == self.USER_CONTROL_POINT:
+            if rx_bytes[0] == 0x20 and len(rx_bytes) >= 3:
+                # ResponseCode: request opcode, response value
+                self._resolve_response(rx_channel_uuid, rx_bytes[1], rx_bytes)
+
+    def _frame_record_packet(self, data):
+        # a record is one packet, or two packets when MultiplePacketMeasurement is set, see FrameAssembler
+        records = self.assembler.feed(data)
+        if not records:
+            return
+        if self.record_queue is not None:
+            for record in records:
+                self.record_queue.put_nowait(record)
+        self.records_received += len(records)
+        if self.records_expected is not None and self.records_received >= self.records_expected:
+            if self.records_complete is not None and not self.records_complete.done():
+                self.records_complete.set_result(self.records_received)
+
+    def _resolve_response(self, char, request_opcode, rx_bytes):
+        future = self.pending_responses.pop((char, request_opcode), None)
+        if future is not None and not future.done():
+            future.set_result(bytes(rx_bytes))
 
     async def register_user(self, user_index):
         self.logger.info(f"Register user started for user #{user_index}")
@@ -87,50 +299,127 @@ class OmronBLE:
 
         self.logger.info("Step 1")
         packet = get_register_new_user(user_index)
-        await self.send(self.USER_CONTROL_POINT, convert_byte_array_to_hex_string(packet))
+        await self.request(self.USER_CONTROL_POINT, packet)
 
         self.logger.info("Step 2 Consent")
-        packet = get_consent(user_index)
-        await self.send(self.USER_CONTROL_POINT, convert_byte_array_to_hex_string(packet))
+        await self._consent(user_index)
         last_sequence = 0
-        packet = get_filter(last_sequence, reportCountOnly=True)
-        await self.send(self.RECORD_ACCESS_CONTROL_POINT, convert_byte_array_to_hex_string(packet))
-
-        packet = get_filter(last_sequence, reportCountOnly=False)
-        await self.send(self.RECORD_ACCESS_CONTROL_POINT, convert_byte_array_to_hex_string(packet))
-        await self.send(self.RECORD_ACCESS_CONTROL_POINT, "1000")
+        await self._report_number_of_records(last_sequence)
+        await self._report_records(last_sequence)
 
         await self._disable_rx_channel_notify_and_callback()
 
     async def get_records(self, user_index, last_sequence):
+        number_of_records = await self.get_record_count(user_index, last_sequence)
+        if number_of_records == 0:
+            await self._disable_rx_channel_notify_and_callback()
+            return []
+        return await self.transfer_records(last_sequence)
+
+    async def get_record_count(self, user_index, last_sequence):
+        # switches to the user and asks for the number of records from last_sequence on
+        # None if the scale did not report a count
         await self._enable_rx_channel_notify_and_callback()
+        await self._consent(user_index)
+        await self._report_number_of_records(last_sequence)
+        return self.number_of_records
+
+    async def transfer_records(self, last_sequence):
+        # transfers the records of the user selected by get_record_count
+        return [measurement async for measurement in self.stream_records(last_sequence)]
+
+    async def stream_records(self, last_sequence):
+        # transfers the records of the user selected by get_record_count and yields every measurement
+        # as soon as its packets have arrived
+        queue = self.record_queue = asyncio.Queue()
+        transfer = asyncio.ensure_future(self._report_records(last_sequence, expected=self.number_of_records))
+        # the end marker is queued behind all records that arrived before the transfer finished
+        transfer.add_done_callback(lambda _: queue.put_nowait(None))
+        try:
+            while True:
+                record = await queue.get()
+                if record is None:
+                    break
+                with metrics.span("decode"):
+                    bcm = OmronMeasurementWS(data1=record[0], data2=record[1], feature=self.feature)
+                metrics.count("records_decoded")
+                self.logger.info(f"Got measurement index {bcm.mSequenceNumber} with weight {bcm.mWeight}")
+                yield bcm
+            transfer.result()
+        finally:
+            transfer.cancel()
+            self.record_queue = None
+        await self._disable_rx_channel_notify_and_callback()
 
-        packet = get_consent(user_index)
-        await self.send(self.USER_CONTROL_POINT, convert_byte_array_to_hex_string(packet))
-
-        packet = get_filter(last_sequence, reportCountOnly=True)
-        await self.send(self.RECORD_ACCESS_CONTROL_POINT, convert_byte_array_to_hex_string(packet))
-
-        packet = get_filter(last_sequence, reportCountOnly=False)
-        await self.send(self.RECORD_ACCESS_CONTROL_POINT, convert_byte_array_to_hex_string(packet))
-        await self.send(self.RECORD_ACCESS_CONTROL_POINT, "1000")
+    async def _consent(self, user_index):
+        response = await self.request(self.USER_CONTROL_POINT, get_consent(user_index))
+        if response[2] != 0x01:
+            raise OmronResponseError(f"Consent for user #{user_index} rejected with response code {response[2]}")
 
-        measurements = []
-        if self.rx_raw_channel_buffer[2]:
-            data = self.rx_raw_channel_buffer[2]
+    async def _report_number_of_records(self, last_sequence):
+        self.number_of_records = None
+        await self.request(self.RECORD_ACCESS_CONTROL_POINT, get_filter(last_sequence, reportCountOnly=True))
 
-            for i in range(0, len(data), 35):
-                bcm = OmronMeasurementWS(data1=data[i : i + 19], data2=data[i + 19 : i + 35])
-                measurements.append(bcm)
-                self.logger.info(f"Got measurement index {bcm.mSequenceNumber} with weight {bcm.mWeight}")
+    async def _report_records(self, last_sequence, expected=None):
+        # returns once the scale confirmed the transfer or, if expected is given, as soon as that many records arrived
+        self.records_received = 0
+        self.records_expected = expected
+        self.assembler = FrameAssembler(self.feature)
+        self.records_complete = asyncio.get_running_loop().create_future()
+        if expected == 0:
+            self.records_complete.set_result(0)
 
-        await self._disable_rx_channel_notify_and_callback()
-        return measurements
+        packet = get_filter(last_sequence, reportCountOnly=False)
+        transfer = asyncio.ensure_future(
+            self.request(self.RECORD_ACCESS_CONTROL_POINT, packet, timeout=self.TRANSFER_TIMEOUT, phase="transfer")
+        )
+        try:
+            await asyncio.wait([transfer, self.records_complete], return_when=asyncio.FIRST_COMPLETED)
+            if self.assembler.dropped:
+                metrics.count("packets_dropped", self.assembler.dropped)
+                self.logger.warning(f"{self.assembler.dropped} measurement packets could not be framed")
+            if self.records_complete.done():
+                self.logger.info(f"All {self.records_received} expected records received")
+            else:
+                response = transfer.result()
+                # 0x01 success, 0x06 no records found
+                if response[3] not in (0x01, 0x06):
+                    raise OmronResponseError(f"Record transfer failed with response code {response[3]}")
+        finally:
+            transfer.cancel()
+            self.records_complete = None
+            self.records_expected = None
+        try:
+            await self.request(
+                self.RECORD_ACCESS_CONTROL_POINT, bytes.fromhex("1000"), timeout=self.FINISH_TIMEOUT, phase="finish"
+            )
+        except asyncio.TimeoutError:
+            # not every firmware answers this one, the records are already transferred at this point
+            self.logger.debug("No response to 1000")
+
+    async def request(self, char, packet, timeout=None, phase="request"):
+        # writes a control point request and waits until the matching response code has been received
+        # the round trip is timed as phase
+        future = asyncio.get_running_loop().create_future()
+        self.pending_responses[(char, packet[0])] = future
+        try:
+            with metrics.span(phase):
+                await self.send(char, convert_byte_array_to_hex_string(packet))
+                return await asyncio.wait_for(future, timeout or self.RESPONSE_TIMEOUT)
+        finally:
+            self.pending_responses.pop((char, packet[0]), None)
 
     async def send(self, char, data):
         self.logger.debug(f"tx > {char} {data}")
         await self.ble_client.write_gatt_char(char, bytearray.fromhex(data)[:16])
-        await asyncio.sleep(3)
+
+
+class OmronResponseError(Exception):
+    pass
+
+
+class OmronPairingError(Exception):
+    pass
 
 
 def get_consent(userIndex):
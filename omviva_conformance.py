@@ -0,0 +1,399 @@
+# conformance check and throughput benchmark for the measurement decoder in omviva_measurement.py
+#
+#   python3 omviva_conformance.py --cases 5000 --seed 7 --records 20000
+#
+# A reference encoder, written from the field table of the Body Composition Measurement (not from the decoder),
+# builds packets for random flag combinations, field values, units and BodyCompositionFeature resolutions. Every
+# generated record must decode to the values it was built from, with OmronMeasurementWS, with decode_many (numpy
+# and object path) and after framing the packets with frame_packets. The captured notifications below are checked
+# against their known values, and framed again with a lost and a broken notification. Failing cases are printed
+# with their packets and the seed to reproduce them. Afterwards the records per second of single and batch decoding
+# are measured. Exits with 1 on any failure.
+
+import argparse
+import random
+import struct
+import sys
+import time
+from datetime import datetime
+from decimal import Decimal, ROUND_HALF_UP
+
+import omviva_measurement
+from omviva_measurement import OmronMeasurementWS, BodyCompositionFeature, Flag, FrameAssembler
+from omviva_measurement import decode_many, frame_packets
+
+# (flag, attribute, struct format, scaling, decimals) in packet order
+# scaling: None for integers, "weight" and "height" for the unit and feature dependent resolution, or the factors
+FIELDS = (
+    (Flag.SequenceNumberPresent, "mSequenceNumber", "H", None, None),
+    (Flag.WeightPresent, "mWeight", "H", "weight", 3),
+    (Flag.TimeStampPresent, "mTimeStamp", "HBBBBB", "timestamp", None),
+    (Flag.UserIDPresent, "mUserID", "B", None, None),
+    (Flag.BMIAndHeightPresent, "mBMI", "H", (0.1,), 3),
+    (Flag.BMIAndHeightPresent, "mHeight", "H", "height", 1),
+    (Flag.BodyFatPercentagePresent, "mBodyFatPercentage", "H", (0.1, 0.01), 3),
+    (Flag.BasalMetabolismPresent, "mBasalMetabolism", "H", None, None),
+    (Flag.MusclePercentagePresent, "mMusclePercentage", "H", (0.1, 0.01), 3),
+    (Flag.MuscleMassPresent, "mMuscleMass", "H", "weight", 3),
+    (Flag.FatFreeMassPresent, "mFatFreeMass", "H", "weight", 3),
+    (Flag.SoftLeanMassPresent, "mSoftLeanMass", "H", "weight", 3),
+    (Flag.BodyWaterMassPresent, "mBodyWaterMass", "H", "weight", 3),
+    (Flag.ImpedancePresent, "mImpedance", "H", (0.1,), 3),
+    (Flag.SkeletalMusclePercentagePresent, "mSkeletalMusclePercentage", "H", (0.1, 0.01), 3),
+    (Flag.VisceralFatLevelPresent, "mVisceralFatLevel", "B", (0.5,), 3),
+    (Flag.BodyAgePresent, "mBodyAge", "B", None, None),
+    (Flag.BodyFatPercentageStageEvaluationPresent, "mBodyFatPercentageStageEvaluation", "B", None, None),
+    (Flag.SkeletalMusclePercentageStageEvaluationPresent, "mSkeletalMusclePercentageStageEvaluation", "B", None, None),
+    (Flag.VisceralFatLevelStageEvaluationPresent, "mVisceralFatLevelStageEvaluation", "B", None, None),
+)
+FIELD_FLAGS = tuple(dict.fromkeys(field[0] for field in FIELDS))
+ATTRIBUTES = tuple(field[1] for field in FIELDS)
+
+# resolution code of the feature -> (kg, lb) and (m, in), code 0 (not specified) means the default
+WEIGHT_RESOLUTIONS = {
+    0: (0.005, 0.01),
+    1: (0.5, 1.0),
+    2: (0.2, 0.5),
+    3: (0.1, 0.2),
+    4: (0.05, 0.1),
+    5: (0.02, 0.05),
+    6: (0.01, 0.02),
+    7: (0.005, 0.01),
+}
+HEIGHT_RESOLUTIONS = {0: (0.001, 0.1), 1: (0.01, 1.0), 2: (0.005, 0.5), 3: (0.001, 0.1)}
+
+# captured notifications of three records (two packets each, 19 and 16 bytes) with their known values
+CAPTURE = bytes.fromhex(
+    "3e00100100903de8070c010a173801fe00e006c2c01f0100e9009a1b600108340906063e00100200903de8070c010a2b1701fe00e006c2c01f0200ec00471b570108370906063e00100300cc3de8070c1e101c2d01ff00e006c2c01f0300dd00bb1c7e01082b090606"
+)
+CAPTURE_PACKET_SIZES = (19, 16)
+CAPTURE_ATTRIBUTES = (
+    "mSequenceNumber",
+    "mUserID",
+    "mTimeStamp",
+    "mWeight",
+    "mBMI",
+    "mHeight",
+    "mBodyFatPercentage",
+    "mBasalMetabolism",
+    "mSkeletalMusclePercentage",
+    "mVisceralFatLevel",
+    "mBodyAge",
+    "mBodyFatPercentageStageEvaluation",
+    "mSkeletalMusclePercentageStageEvaluation",
+    "mVisceralFatLevelStageEvaluation",
+)
+CAPTURE_VALUES = (
+    (1, 1, 1733048636, "78.8", "25.4", "1.8", "0.233", 7066, "0.352", "4", 52, 9, 6, 6),
+    (2, 1, 1733049803, "78.8", "25.4", "1.8", "0.236", 6983, "0.343", "4", 55, 9, 6, 6),
+    (3, 1, 1735576125, "79.1", "25.5", "1.8", "0.221", 7355, "0.382", "4", 43, 9, 6, 6),
+)
+
+_EPOCH = datetime(1970, 1, 1)
+
+
+class Case:
+    # one generated record: its packets and the attribute values they have to decode to
+
+    def __init__(self, packets, expected, flags):
+        self.packets = packets
+        self.expected = expected
+        self.flags = flags
+
+    def describe(self):
+        return " ".join(packet.hex() for packet in self.packets)
+
+
+def feature_word(weight_code, height_code, supported=0):
+    return supported | weight_code << 11 | height_code << 15
+
+
+def resolutions(imperial, feature_codes):
+    # (weight, height) resolution of a record
+    weight_code, height_code = feature_codes or (0, 0)
+    unit = 1 if imperial else 0
+    return WEIGHT_RESOLUTIONS[weight_code][unit], HEIGHT_RESOLUTIONS[height_code][unit]
+
+
+def expected_value(scaling, decimals, raw, weight_resolution, height_resolution):
+    # like the Android SDK: double arithmetic, then BigDecimal.setScale(decimals, HALF_UP)
+    if scaling is None:
+        return raw
+    if scaling == "timestamp":
+        # seconds of the scale's local time since 1970-01-01
+        return int((datetime(*raw) - _EPOCH).total_seconds())
+    factors = {"weight": (weight_resolution,), "height": (height_resolution,)}.get(scaling, scaling)
+    value = raw
+    for factor in factors:
+        value = value * factor
+    return Decimal(value).quantize(Decimal(1).scaleb(-decimals), rounding=ROUND_HALF_UP)
+
+
+def encode_packet(flags, raws):
+    # reference encoder: 24 bit flags, then the fields of the set flags in FIELDS order
+    data = bytearray(flags.to_bytes(3, "little"))
+    for flag, attribute, fmt, scaling, decimals in FIELDS:
+        if flags & flag:
+            raw = raws[attribute]
+            data += struct.pack("<" + fmt, *(raw if scaling == "timestamp" else (raw,)))
+    return bytes(data)
+
+
+def random_raw(rng, fmt):
+    if fmt == "HBBBBB":
+        day = datetime(2000, 1, 1) + (datetime(2100, 1, 1) - datetime(2000, 1, 1)) * rng.random()
+        return (day.year, day.month, day.day, day.hour, day.minute, day.second)
+    maximum = 0xFFFF if fmt == "H" else 0xFF
+    # the limits are picked more often than their share
+    if rng.random() < 0.1:
+        return rng.choice((0, 1, maximum))
+    return rng.randint(0, maximum)
+
+
+def random_flags(rng):
+    # (flags of the first packet, flags of the second packet or None), the fields are spread over both packets
+    # every packet has a field, a packet without one is taken for padding like on the scale
+    imperial = Flag.ImperialUnit if rng.random() < 0.5 else 0
+    present = [flag for flag in FIELD_FLAGS if rng.random() < 0.5] or [rng.choice(FIELD_FLAGS)]
+    if len(present) < 2 or rng.random() < 0.4:
+        return imperial | sum(present), None
+    first, second = present[0], present[-1]
+    for flag in present[1:-1]:
+        if rng.random() < 0.5:
+            first |= flag
+        else:
+            second |= flag
+    return imperial | Flag.MultiplePacketMeasurement | first, imperial | second
+
+
+def make_case(rng, flags, feature_codes):
+    raws = {attribute: random_raw(rng, fmt) for flag, attribute, fmt, scaling, decimals in FIELDS}
+    imperial = bool(flags[0] & Flag.ImperialUnit)
+    weight_resolution, height_resolution = resolutions(imperial, feature_codes)
+    packets = [encode_packet(packetFlags, raws) for packetFlags in flags if packetFlags is not None]
+    present = flags[0] | (flags[1] or 0)
+    expected = {
+        "mWeightUnit": OmronMeasurementWS.WEIGHT_UNIT_POUND if imperial else OmronMeasurementWS.WEIGHT_UNIT_KILOGRAM,
+        "mHeightUnit": OmronMeasurementWS.HEIGHT_UNIT_INCH if imperial else OmronMeasurementWS.HEIGHT_UNIT_METER,
+    }
+    for flag, attribute, fmt, scaling, decimals in FIELDS:
+        expected[attribute] = (
+            expected_value(scaling, decimals, raws[attribute], weight_resolution, height_resolution)
+            if present & flag
+            else None
+        )
+    return Case(packets, expected, present)
+
+
+def generate(rng, cases):
+    # yields (feature codes or None, cases) batches, records of a batch often share their flags like a real backlog
+    while cases > 0:
+        feature_codes = None if rng.random() < 0.5 else (rng.randint(0, 7), rng.randint(0, 3))
+        batch = []
+        for _ in range(rng.randint(1, 8)):
+            flags = random_flags(rng)
+            batch.extend(make_case(rng, flags, feature_codes) for _ in range(rng.randint(1, 40)))
+        batch = batch[:cases]
+        cases -= len(batch)
+        yield feature_codes, batch
+
+
+def compare(case, actual, where):
+    # actual maps the attributes to decoded values, returns the differences as text
+    differences = []
+    for attribute, value in case.expected.items():
+        if attribute not in actual:
+            continue
+        got = actual[attribute]
+        same = got is None if value is None else got is not None and got == value
+        if not same:
+            differences.append(f"{where}: {attribute} is {got!r}, expected {value!r} (packets {case.describe()})")
+    return differences
+
+
+def check_single(cases, feature):
+    differences = []
+    for case in cases:
+        measurement = OmronMeasurementWS(*case.packets, feature=feature)
+        actual = {attribute: getattr(measurement, attribute) for attribute in case.expected}
+        differences += compare(case, actual, "single")
+    return differences
+
+
+def batch_value(value, expected):
+    # the batch columns hold floats and ints, absent values are None, NaN (float) or -1 (int)
+    if value is None or value != value or (value == -1 and expected is None):
+        return None
+    if expected is not None and value == float(expected):
+        return expected
+    return value
+
+
+def check_batch(cases, feature, decoder, where):
+    columns = decoder(b"".join(packet for case in cases for packet in case.packets), feature)
+    if len(columns["SequenceNumber"]) != len(cases):
+        return [f"{where}: {len(columns['SequenceNumber'])} records decoded, expected {len(cases)}"]
+    differences = []
+    for row, case in enumerate(cases):
+        actual = {
+            attribute: batch_value(columns[attribute[1:]][row], case.expected[attribute]) for attribute in ATTRIBUTES
+        }
+        imperial = case.expected["mWeightUnit"] == OmronMeasurementWS.WEIGHT_UNIT_POUND
+        if bool(columns["ImperialUnit"][row]) != imperial:
+            differences.append(f"{where}: ImperialUnit of record {row} is wrong (packets {case.describe()})")
+        differences += compare(case, actual, where)
+    return differences
+
+
+def check_framing(cases):
+    packets = [packet for case in cases for packet in case.packets]
+    framed = list(frame_packets(packets))
+    expected = [(case.packets[0], case.packets[1] if len(case.packets) > 1 else None) for case in cases]
+    if framed != expected:
+        return [f"framing: {len(framed)} records framed, expected {len(expected)} with the same packets"]
+    # the same packets arriving back to back in one notification
+    framed = list(frame_packets([b"".join(packets)]))
+    if framed != expected:
+        return [f"framing: {len(framed)} records framed from one notification, expected {len(expected)}"]
+    return []
+
+
+def check_lost_packets():
+    # a lost or broken notification costs only its own record, the next records are framed from their own packets
+    records = [case.packets for case in capture_cases()]
+    expected = [tuple(packets) for packets in records[1:]]
+    scenarios = (
+        ("broken second packet", [records[0][0], b"\x3e\x00"] + records[1] + records[2], 2),
+        ("lost second packet", [records[0][0]] + records[1] + records[2], 1),
+    )
+    differences = []
+    for name, notifications, dropped in scenarios:
+        assembler = FrameAssembler()
+        framed = list(frame_packets(notifications, assembler=assembler))
+        if framed != expected or assembler.dropped != dropped:
+            differences.append(
+                f"framing after a {name}: {len(framed)} records framed and {assembler.dropped} packets dropped, "
+                f"expected {len(expected)} and {dropped}"
+            )
+    return differences
+
+
+def check_features(rng, count):
+    # resolutions and supported flags of random feature words
+    differences = []
+    for _ in range(count):
+        weight_code, height_code, supported = rng.randint(0, 7), rng.randint(0, 3), rng.getrandbits(11)
+        word = feature_word(weight_code, height_code, supported)
+        feature = BodyCompositionFeature(word.to_bytes(4, "little"))
+        actual = (
+            feature.get_weight_measurement_resolution_kg(),
+            feature.get_weight_measurement_resolution_lb(),
+            feature.get_height_measurement_resolution_m(),
+            feature.get_height_measurement_resolution_in(),
+        )
+        expected = WEIGHT_RESOLUTIONS[weight_code] + HEIGHT_RESOLUTIONS[height_code]
+        if actual != expected:
+            differences.append(f"feature {word:#010x}: resolutions {actual}, expected {expected}")
+        if sum(feature.get_supported_flags()) != supported:
+            differences.append(f"feature {word:#010x}: supported flags {feature.get_supported_flags()}")
+    return differences
+
+
+def capture_cases():
+    first, second = CAPTURE_PACKET_SIZES
+    cases = []
+    for index, values in enumerate(CAPTURE_VALUES):
+        record = CAPTURE[index * (first + second) : (index + 1) * (first + second)]
+        expected = {attribute: None for attribute in ATTRIBUTES}
+        expected["mWeightUnit"] = OmronMeasurementWS.WEIGHT_UNIT_KILOGRAM
+        expected["mHeightUnit"] = OmronMeasurementWS.HEIGHT_UNIT_METER
+        for attribute, value in zip(CAPTURE_ATTRIBUTES, values):
+            expected[attribute] = Decimal(value) if isinstance(value, str) else value
+        cases.append(Case([record[:first], record[first:]], expected, None))
+    return cases
+
+
+def conformance(cases, seed):
+    # returns (records checked, differences, flags never exercised)
+    rng = random.Random(seed)
+    decoders = [(omviva_measurement._decode_many_objects, "batch objects")]
+    if omviva_measurement._load_numpy() is not None:
+        decoders.append((decode_many, "batch numpy"))
+
+    batches = [(None, capture_cases())] + list(generate(rng, cases))
+    differences = check_features(rng, 200) + check_lost_packets()
+    checked = 0
+    covered = 0
+    for feature_codes, batch in batches:
+        feature = None
+        if feature_codes is not None:
+            feature = BodyCompositionFeature(feature_word(*feature_codes).to_bytes(4, "little"))
+        differences += check_single(batch, feature)
+        for decoder, where in decoders:
+            differences += check_batch(batch, feature, decoder, where)
+        differences += check_framing(batch)
+        checked += len(batch)
+        for case in batch:
+            covered |= case.flags or 0
+            if len(case.packets) > 1:
+                covered |= Flag.MultiplePacketMeasurement
+            if case.expected["mWeightUnit"] == OmronMeasurementWS.WEIGHT_UNIT_POUND:
+                covered |= Flag.ImperialUnit
+    missing = [flag.name for flag in Flag if not covered & flag]
+    return checked, differences, missing
+
+
+def benchmark(records, repeat):
+    # records per second for (name, decode function) on a backlog built from the capture, best of repeat runs
+    first, second = CAPTURE_PACKET_SIZES
+    size = first + second
+    buffer = b"".join(CAPTURE[(index % 3) * size : (index % 3 + 1) * size] for index in range(records))
+    packets = []
+    for offset in range(0, len(buffer), size):
+        packets += [buffer[offset : offset + first], buffer[offset + first : offset + size]]
+
+    def single():
+        for data1, data2 in frame_packets(packets):
+            OmronMeasurementWS(data1, data2)
+
+    runs = [("single", single), ("batch objects", lambda: omviva_measurement._decode_many_objects(buffer, None))]
+    if omviva_measurement._load_numpy() is not None:
+        runs.append(("batch numpy", lambda: decode_many(buffer)))
+    results = []
+    for name, function in runs:
+        best = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            function()
+            duration = time.perf_counter() - start
+            best = duration if best is None else min(best, duration)
+        results.append((name, records / best if best else 0.0))
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Check the measurement decoder against a reference encoder")
+    parser.add_argument("--cases", type=int, default=2000, help="number of generated records")
+    parser.add_argument("--seed", type=int, help="seed of the generator (default: random)")
+    parser.add_argument("--records", type=int, default=20000, help="records per benchmark run, 0 to skip it")
+    parser.add_argument("--repeat", type=int, default=3, help="benchmark runs, the best one counts")
+    parser.add_argument("--show", type=int, default=10, help="number of failures to print")
+    args = parser.parse_args(argv)
+
+    seed = args.seed if args.seed is not None else random.randrange(1 << 32)
+    checked, differences, missing = conformance(args.cases, seed)
+    for difference in differences[: args.show]:
+        print(difference)
+    if missing:
+        print(f"flags never exercised: {', '.join(missing)}")
+    status = "ok" if not differences and not missing else f"{len(differences)} FAILURES"
+    print(f"{checked} records checked with seed {seed}: {status}")
+
+    if args.records:
+        for name, rate in benchmark(args.records, args.repeat):
+            print(f"{name:14} {rate:10.0f} records/s")
+    return 1 if differences or missing else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
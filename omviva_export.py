@@ -0,0 +1,173 @@
+# streams the measurements to CSV, JSON Lines or Parquet
+#
+#   python3 omviva_export.py csv measurements.csv --user 1 --start 2024-01-01 --end 2025-01-01
+#   python3 omviva_export.py jsonl measurements.jsonl --watermark measurements.watermark
+#   python3 omviva_export.py parquet measurements.parquet
+#
+# Rows are read in chunks (VivaPersistence.iter_measurements), so the memory use stays the same for any number of
+# rows. With --watermark the rowid of the last exported row is kept in the given file and the next export only
+# writes the rows added since then, appended to the CSV or JSON Lines output. Parquet needs pyarrow and cannot be
+# appended to, so a resumed export writes the new rows to a part file next to the output, named after the
+# watermark it starts from (measurements.1234.parquet), and the previous files are kept.
+
+import argparse
+import csv
+import json
+import sys
+from datetime import datetime, timedelta
+from itertools import islice
+from pathlib import Path
+
+from omviva_persistence import VivaPersistence, MEASUREMENT_COLUMNS, SCALED_COLUMNS, EXPORT_CHUNK_SIZE
+
+FORMATS = ("csv", "jsonl", "parquet")
+# TimeStamp counts the seconds of the scale's local time since 1970-01-01
+_EPOCH = datetime(1970, 1, 1)
+
+
+class CsvWriter:
+    def __init__(self, output, append):
+        self.output = output
+        self.writer = csv.writer(output)
+        if not append:
+            self.writer.writerow(MEASUREMENT_COLUMNS)
+
+    def write(self, rows):
+        self.writer.writerows(rows)
+
+    def close(self):
+        self.output.flush()
+
+
+class JsonLinesWriter:
+    def __init__(self, output, append):
+        self.output = output
+
+    def write(self, rows):
+        self.output.writelines(json.dumps(dict(zip(MEASUREMENT_COLUMNS, row))) + "\n" for row in rows)
+
+    def close(self):
+        self.output.flush()
+
+
+class ParquetWriter:
+    # one row group per chunk
+    def __init__(self, path):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise RuntimeError("Parquet export needs pyarrow (pip install pyarrow)")
+        self.pyarrow = pyarrow
+        fields = []
+        for column in MEASUREMENT_COLUMNS:
+            scaled = column in SCALED_COLUMNS
+            fields.append(pyarrow.field(column, pyarrow.float64() if scaled else pyarrow.int64()))
+        self.schema = pyarrow.schema(fields)
+        self.writer = pyarrow.parquet.ParquetWriter(path, self.schema)
+
+    def write(self, rows):
+        columns = [list(column) for column in zip(*rows)]
+        self.writer.write_table(self.pyarrow.Table.from_arrays(columns, schema=self.schema))
+
+    def close(self):
+        self.writer.close()
+
+
+def export(persistence, writer, user_id=None, start=None, end=None, after_rowid=0, chunk_size=EXPORT_CHUNK_SIZE):
+    # writes the matching measurements after after_rowid, returns (rows written, rowid of the last row)
+    written = 0
+    last_rowid = after_rowid
+    rows = persistence.iter_measurements(user_id, start, end, after_rowid, chunk_size)
+    while True:
+        chunk = list(islice(rows, chunk_size))
+        if not chunk:
+            break
+        writer.write([row for rowid, row in chunk])
+        written += len(chunk)
+        last_rowid = chunk[-1][0]
+    return written, last_rowid
+
+
+def parse_time(value):
+    # seconds like the TimeStamp column, from a number or an ISO date (and time)
+    if value is None:
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        return (datetime.fromisoformat(value) - _EPOCH) // timedelta(seconds=1)
+
+
+def part_path(output, after_rowid):
+    # the Parquet file of an export resumed after after_rowid
+    output = Path(output)
+    return output.with_name(f"{output.stem}.{after_rowid}{output.suffix}")
+
+
+def read_watermark(path):
+    if path is None or not Path(path).exists():
+        return 0
+    return int(Path(path).read_text().strip() or 0)
+
+
+def write_watermark(path, rowid):
+    # replaced in one step, so an interrupted export keeps the previous watermark
+    temporary = Path(str(path) + ".tmp")
+    temporary.write_text(f"{rowid}\n")
+    temporary.replace(path)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Export the Omron VIVA measurements")
+    parser.add_argument("format", choices=FORMATS)
+    parser.add_argument("output", help="output file, - for stdout (csv and jsonl)")
+    parser.add_argument("--db", default="viva_measurements.db", help="database file")
+    parser.add_argument("--user", type=int, help="only this user")
+    parser.add_argument("--start", help="first time to export, seconds or ISO date")
+    parser.add_argument("--end", help="time to stop at (exclusive), seconds or ISO date")
+    parser.add_argument("--watermark", help="file keeping the last exported rowid, to resume from")
+    parser.add_argument("--chunk-size", type=int, default=EXPORT_CHUNK_SIZE, help="rows per fetch and row group")
+    args = parser.parse_args(argv)
+
+    if args.format == "parquet" and args.output == "-":
+        parser.error("parquet cannot be written to stdout")
+    after_rowid = read_watermark(args.watermark)
+
+    if args.format == "parquet" and after_rowid > 0:
+        args.output = str(part_path(args.output, after_rowid))
+
+    persistence = VivaPersistence(db_name=args.db)
+    output = None
+    try:
+        if args.format == "parquet":
+            writer = ParquetWriter(args.output)
+        else:
+            append = after_rowid > 0 and args.output != "-" and Path(args.output).exists()
+            if args.output == "-":
+                output = sys.stdout
+            else:
+                output = open(args.output, "a" if append else "w", newline="" if args.format == "csv" else None)
+            writer = (CsvWriter if args.format == "csv" else JsonLinesWriter)(output, append)
+        try:
+            written, last_rowid = export(
+                persistence, writer, args.user, parse_time(args.start), parse_time(args.end), after_rowid, args.chunk_size
+            )
+        finally:
+            writer.close()
+    finally:
+        if output is not None and output is not sys.stdout:
+            output.close()
+        persistence.close()
+
+    if args.format == "parquet" and after_rowid > 0 and written == 0:
+        # no empty part file for every export without new rows
+        Path(args.output).unlink()
+    if args.watermark:
+        write_watermark(args.watermark, last_rowid)
+    print(f"Exported {written} measurements", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
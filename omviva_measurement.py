@@ -2,12 +2,19 @@
 
 from enum import Enum, IntFlag, auto
 from decimal import Decimal, ROUND_HALF_UP
-from typing import Optional, List
-import time
-import calendar
+from datetime import datetime, timedelta
+from typing import Optional, List, Tuple, Dict, Iterator
+import struct
+
+# numpy is optional and only imported by the first decode_many call, see _load_numpy
+np = None
+_numpy_loaded = False
 
 
 class OmronMeasurementWS:
+    # GATT characteristic the scale sends the measurements on
+    CHARACTERISTIC_UUID = "8ff2ddfb-4a52-4ce5-85a4-d2f97917792a"
+
     WEIGHT_UNIT_KILOGRAM = "kg"
     WEIGHT_UNIT_POUND = "lb"
     HEIGHT_UNIT_METER = "m"
@@ -19,6 +26,36 @@ class OmronMeasurementWS:
     HEIGHT_RESOLUTION_M_DEFAULT = 0.001
     HEIGHT_RESOLUTION_IN_DEFAULT = 0.1
 
+    __slots__ = (
+        "mWeightUnit",
+        "mHeightUnit",
+        "mSequenceNumber",
+        "mWeight",
+        "mTimeStamp",
+        "mUserID",
+        "mBMI",
+        "mHeight",
+        "mBodyFatPercentage",
+        "mBasalMetabolism",
+        "mMusclePercentage",
+        "mMuscleMass",
+        "mFatFreeMass",
+        "mSoftLeanMass",
+        "mBodyWaterMass",
+        "mImpedance",
+        "mSkeletalMusclePercentage",
+        "mVisceralFatLevel",
+        "mBodyAge",
+        "mBodyFatPercentageStageEvaluation",
+        "mSkeletalMusclePercentageStageEvaluation",
+        "mVisceralFatLevelStageEvaluation",
+        # attribute -> value as sent by the scale (in its units and resolution) for the scaled attributes
+        "mRaw",
+        # resolution codes of the BodyCompositionFeature the record was decoded with, 0 for the defaults
+        "mWeightResolutionCode",
+        "mHeightResolutionCode",
+    )
+
     def __init__(self, data1: bytes, data2: Optional[bytes] = None, feature: Optional["BodyCompositionFeature"] = None):
         self.mWeightUnit = ""
         self.mHeightUnit = ""
@@ -42,150 +79,34 @@ class OmronMeasurementWS:
         self.mBodyFatPercentageStageEvaluation = None
         self.mSkeletalMusclePercentageStageEvaluation = None
         self.mVisceralFatLevelStageEvaluation = None
+        self.mRaw = {}
+        self.mWeightResolutionCode = feature.get_weight_resolution_code() if feature else 0
+        self.mHeightResolutionCode = feature.get_height_resolution_code() if feature else 0
 
         self._parse(data1, feature)
         if data2:
             self._parse(data2, feature)
 
     def _parse(self, data: bytes, feature: Optional["BodyCompositionFeature"]):
-        offset = 0
-        flags = Flag.parse(int.from_bytes(data[offset : offset + 3], byteorder="little") & 0x00FFFFFF)
-        offset += 3
-
-        if Flag.ImperialUnit in flags:
-            weight_measurement_resolution = (
-                feature.get_weight_measurement_resolution_lb() if feature else self.WEIGHT_RESOLUTION_LB_DEFAULT
-            )
-            height_measurement_resolution = (
-                feature.get_height_measurement_resolution_in() if feature else self.HEIGHT_RESOLUTION_IN_DEFAULT
-            )
-            self.mWeightUnit = self.WEIGHT_UNIT_POUND
-            self.mHeightUnit = self.HEIGHT_UNIT_INCH
-        else:
-            weight_measurement_resolution = (
-                feature.get_weight_measurement_resolution_kg() if feature else self.WEIGHT_RESOLUTION_KG_DEFAULT
-            )
-            height_measurement_resolution = (
-                feature.get_height_measurement_resolution_m() if feature else self.HEIGHT_RESOLUTION_M_DEFAULT
-            )
-            self.mWeightUnit = self.WEIGHT_UNIT_KILOGRAM
-            self.mHeightUnit = self.HEIGHT_UNIT_METER
-
-        if Flag.SequenceNumberPresent in flags:
-            self.mSequenceNumber = Decimal(int.from_bytes(data[offset : offset + 2], byteorder="little"))
-            offset += 2
-
-        if Flag.WeightPresent in flags:
-            raw_value = int.from_bytes(data[offset : offset + 2], byteorder="little")
-            self.mWeight = Decimal(raw_value * weight_measurement_resolution).quantize(
-                Decimal("1.000"), rounding=ROUND_HALF_UP
-            )
-            offset += 2
-
-        if Flag.TimeStampPresent in flags:
-            self.mTimeStamp = self._parse_timestamp(data[offset : offset + 7])
-            offset += 7
-
-        if Flag.UserIDPresent in flags:
-            self.mUserID = Decimal(data[offset])
-            offset += 1
-
-        if Flag.BMIAndHeightPresent in flags:
-            raw_value = int.from_bytes(data[offset : offset + 2], byteorder="little")
-            self.mBMI = Decimal(raw_value * 0.1).quantize(Decimal("1.000"), rounding=ROUND_HALF_UP)
-            offset += 2
-
-            raw_value = int.from_bytes(data[offset : offset + 2], byteorder="little")
-            self.mHeight = Decimal(raw_value * height_measurement_resolution).quantize(
-                Decimal("1.0"), rounding=ROUND_HALF_UP
-            )
-            offset += 2
-
-        if Flag.BodyFatPercentagePresent in flags:
-            raw_value = int.from_bytes(data[offset : offset + 2], byteorder="little")
-            self.mBodyFatPercentage = Decimal(raw_value * 0.1 * 0.01).quantize(Decimal("1.000"), rounding=ROUND_HALF_UP)
-            offset += 2
-
-        if Flag.BasalMetabolismPresent in flags:
-            self.mBasalMetabolism = Decimal(int.from_bytes(data[offset : offset + 2], byteorder="little"))
-            offset += 2
-
-        if Flag.MusclePercentagePresent in flags:
-            raw_value = int.from_bytes(data[offset : offset + 2], byteorder="little")
-            self.mMusclePercentage = Decimal(raw_value * 0.1 * 0.01).quantize(Decimal("1.000"), rounding=ROUND_HALF_UP)
-            offset += 2
-
-        if Flag.MuscleMassPresent in flags:
-            raw_value = int.from_bytes(data[offset : offset + 2], byteorder="little")
-            self.mMuscleMass = Decimal(raw_value * weight_measurement_resolution).quantize(
-                Decimal("1.000"), rounding=ROUND_HALF_UP
-            )
-            offset += 2
-
-        if Flag.FatFreeMassPresent in flags:
-            raw_value = int.from_bytes(data[offset : offset + 2], byteorder="little")
-            self.mFatFreeMass = Decimal(raw_value * weight_measurement_resolution).quantize(
-                Decimal("1.000"), rounding=ROUND_HALF_UP
-            )
-            offset += 2
-
-        if Flag.SoftLeanMassPresent in flags:
-            raw_value = int.from_bytes(data[offset : offset + 2], byteorder="little")
-            self.mSoftLeanMass = Decimal(raw_value * weight_measurement_resolution).quantize(
-                Decimal("1.000"), rounding=ROUND_HALF_UP
-            )
-            offset += 2
-
-        if Flag.BodyWaterMassPresent in flags:
-            raw_value = int.from_bytes(data[offset : offset + 2], byteorder="little")
-            self.mBodyWaterMass = Decimal(raw_value * weight_measurement_resolution).quantize(
-                Decimal("1.000"), rounding=ROUND_HALF_UP
-            )
-            offset += 2
-
-        if Flag.ImpedancePresent in flags:
-            raw_value = int.from_bytes(data[offset : offset + 2], byteorder="little")
-            self.mImpedance = Decimal(raw_value * 0.1).quantize(Decimal("1.000"), rounding=ROUND_HALF_UP)
-            offset += 2
-
-        if Flag.SkeletalMusclePercentagePresent in flags:
-            raw_value = int.from_bytes(data[offset : offset + 2], byteorder="little")
-            self.mSkeletalMusclePercentage = Decimal(raw_value * 0.1 * 0.01).quantize(
-                Decimal("1.000"), rounding=ROUND_HALF_UP
-            )
-            offset += 2
-
-        if Flag.VisceralFatLevelPresent in flags:
-            raw_value = data[offset]
-            self.mVisceralFatLevel = Decimal(raw_value * 0.5).quantize(Decimal("1.000"), rounding=ROUND_HALF_UP)
-            offset += 1
-
-        if Flag.BodyAgePresent in flags:
-            self.mBodyAge = Decimal(data[offset])
-            offset += 1
-
-        if Flag.BodyFatPercentageStageEvaluationPresent in flags:
-            self.mBodyFatPercentageStageEvaluation = Decimal(data[offset])
-            offset += 1
-
-        if Flag.SkeletalMusclePercentageStageEvaluationPresent in flags:
-            self.mSkeletalMusclePercentageStageEvaluation = Decimal(data[offset])
-            offset += 1
-
-        if Flag.VisceralFatLevelStageEvaluationPresent in flags:
-            self.mVisceralFatLevelStageEvaluation = Decimal(data[offset])
-            offset += 1
-
-    def _parse_timestamp(self, data: bytes) -> int:
-        year = int.from_bytes(data[0:2], byteorder="little")
-        month = data[2]
-        day = data[3]
-        hour = data[4]
-        minute = data[5]
-        second = data[6]
-        dt = f"{year:04}-{month:02}-{day:02} {hour:02}:{minute:02}:{second:02}"
-        struct_time = time.strptime(dt, "%Y-%m-%d %H:%M:%S")
-        return calendar.timegm(struct_time)
+        flags = int.from_bytes(data[0:3], byteorder="little") & 0x00FFFFFF
+        layout = _get_layout(flags, feature)
+
+        self.mWeightUnit = layout.weight_unit
+        self.mHeightUnit = layout.height_unit
+
+        values = layout.struct.unpack_from(data, 3)
+        raw = self.mRaw
+        for attr, index, table in layout.fields:
+            value = values[index]
+            if table.factors is not None:
+                raw[attr] = value
+            setattr(self, attr, table[value])
+        if layout.timestamp_index is not None:
+            self.mTimeStamp = self._parse_timestamp(values[layout.timestamp_index : layout.timestamp_index + 6])
+
+    def _parse_timestamp(self, fields) -> int:
+        # fields are (year, month, day, hour, minute, second) as unpacked from the packet
+        return (datetime(*fields) - _EPOCH) // _ONE_SECOND
 
     def __str__(self):
         return (
@@ -239,9 +160,11 @@ class BodyCompositionFeature:
         feature = int.from_bytes(data[:4], byteorder="little")
         self.mSupportedFlags = SupportedFlag.parse(feature)
         number_of_weight_measurement_resolution = (feature >> 11) & 0x0000000F
+        self.mWeightResolutionCode = number_of_weight_measurement_resolution
         self.mWeightMeasurementResolutionKG = self.WEIGHT_RESOLUTION_KG[number_of_weight_measurement_resolution]
         self.mWeightMeasurementResolutionLB = self.WEIGHT_RESOLUTION_LB[number_of_weight_measurement_resolution]
         number_of_height_measurement_resolution = (feature >> 15) & 0x00000007
+        self.mHeightResolutionCode = number_of_height_measurement_resolution
         self.mHeightMeasurementResolutionM = self.HEIGHT_RESOLUTION_M[number_of_height_measurement_resolution]
         self.mHeightMeasurementResolutionIn = self.HEIGHT_RESOLUTION_IN[number_of_height_measurement_resolution]
 
@@ -269,6 +192,12 @@ class BodyCompositionFeature:
     def get_height_measurement_resolution_in(self):
         return self.mHeightMeasurementResolutionIn
 
+    def get_weight_resolution_code(self):
+        return self.mWeightResolutionCode
+
+    def get_height_resolution_code(self):
+        return self.mHeightResolutionCode
+
 
 class SupportedFlag(IntFlag):
     TimeStamp = 1
@@ -286,3 +215,425 @@ class SupportedFlag(IntFlag):
     @staticmethod
     def parse(bits: int) -> List["SupportedFlag"]:
         return [flag for flag in SupportedFlag if flag & bits]
+
+
+# precompiled packet layouts
+#
+# The field order and scaling below follow _parse of the original Java implementation. For every distinct
+# flags word (and set of resolutions) a layout is compiled once: a single struct.Struct covering all present
+# fields plus a table mapping each unpacked value to its attribute. Scaled values are memoized per raw value,
+# so the Decimal quantize work is only done the first time a raw value shows up.
+
+_EPOCH = datetime(1970, 1, 1)
+_ONE_SECOND = timedelta(seconds=1)
+
+_WEIGHT = "weight"
+_HEIGHT = "height"
+_TIMESTAMP = "timestamp"
+_Q3 = Decimal("1.000")
+_Q1 = Decimal("1.0")
+
+# (flag, struct format, attribute, scale factors, quantum)
+_FIELDS = (
+    (Flag.SequenceNumberPresent, "H", "mSequenceNumber", None, None),
+    (Flag.WeightPresent, "H", "mWeight", _WEIGHT, _Q3),
+    (Flag.TimeStampPresent, "HBBBBB", "mTimeStamp", _TIMESTAMP, None),
+    (Flag.UserIDPresent, "B", "mUserID", None, None),
+    (Flag.BMIAndHeightPresent, "H", "mBMI", (0.1,), _Q3),
+    (Flag.BMIAndHeightPresent, "H", "mHeight", _HEIGHT, _Q1),
+    (Flag.BodyFatPercentagePresent, "H", "mBodyFatPercentage", (0.1, 0.01), _Q3),
+    (Flag.BasalMetabolismPresent, "H", "mBasalMetabolism", None, None),
+    (Flag.MusclePercentagePresent, "H", "mMusclePercentage", (0.1, 0.01), _Q3),
+    (Flag.MuscleMassPresent, "H", "mMuscleMass", _WEIGHT, _Q3),
+    (Flag.FatFreeMassPresent, "H", "mFatFreeMass", _WEIGHT, _Q3),
+    (Flag.SoftLeanMassPresent, "H", "mSoftLeanMass", _WEIGHT, _Q3),
+    (Flag.BodyWaterMassPresent, "H", "mBodyWaterMass", _WEIGHT, _Q3),
+    (Flag.ImpedancePresent, "H", "mImpedance", (0.1,), _Q3),
+    (Flag.SkeletalMusclePercentagePresent, "H", "mSkeletalMusclePercentage", (0.1, 0.01), _Q3),
+    (Flag.VisceralFatLevelPresent, "B", "mVisceralFatLevel", (0.5,), _Q3),
+    (Flag.BodyAgePresent, "B", "mBodyAge", None, None),
+    (Flag.BodyFatPercentageStageEvaluationPresent, "B", "mBodyFatPercentageStageEvaluation", None, None),
+    (Flag.SkeletalMusclePercentageStageEvaluationPresent, "B", "mSkeletalMusclePercentageStageEvaluation", None, None),
+    (Flag.VisceralFatLevelStageEvaluationPresent, "B", "mVisceralFatLevelStageEvaluation", None, None),
+)
+
+
+# flag bits with a meaning, and those announcing a field
+_KNOWN_FLAGS = sum(Flag)
+_FIELD_FLAGS = sum(set(field[0] for field in _FIELDS))
+
+
+class _DecimalTable(dict):
+    # maps a raw integer to its (scaled and quantized) Decimal, filled on first use
+
+    def __init__(self, factors: Optional[Tuple[float, ...]], quantum: Optional[Decimal]):
+        super().__init__()
+        self.factors = factors
+        self.quantum = quantum
+
+    def __missing__(self, raw: int) -> Decimal:
+        if self.factors is None:
+            value = Decimal(raw)
+        else:
+            scaled = raw
+            for factor in self.factors:
+                scaled = scaled * factor
+            value = Decimal(scaled).quantize(self.quantum, rounding=ROUND_HALF_UP)
+        self[raw] = value
+        return value
+
+
+class _Layout:
+    __slots__ = ("flags", "struct", "size", "fields", "columns", "timestamp_index", "weight_unit", "height_unit")
+
+    def __init__(self, flags: int, weight_resolution: float, height_resolution: float):
+        self.flags = flags
+        imperial = bool(flags & Flag.ImperialUnit)
+        self.weight_unit = OmronMeasurementWS.WEIGHT_UNIT_POUND if imperial else OmronMeasurementWS.WEIGHT_UNIT_KILOGRAM
+        self.height_unit = OmronMeasurementWS.HEIGHT_UNIT_INCH if imperial else OmronMeasurementWS.HEIGHT_UNIT_METER
+        self.timestamp_index = None
+
+        fmt = "<"
+        fields = []
+        # (attribute, byte offset in the packet, struct format, table) for the columnar decoder
+        columns = []
+        index = 0
+        offset = 3
+        for flag, field_fmt, attr, factors, quantum in _FIELDS:
+            if not flags & flag:
+                continue
+            if factors == _TIMESTAMP:
+                self.timestamp_index = index
+                columns.append((attr, offset, field_fmt, None))
+            else:
+                if factors == _WEIGHT:
+                    factors = (weight_resolution,)
+                elif factors == _HEIGHT:
+                    factors = (height_resolution,)
+                table = _get_table(factors, quantum)
+                fields.append((attr, index, table))
+                columns.append((attr, offset, field_fmt, table))
+            fmt += field_fmt
+            index += len(field_fmt)
+            offset += struct.calcsize("<" + field_fmt)
+
+        self.struct = struct.Struct(fmt)
+        self.size = 3 + self.struct.size
+        self.fields = tuple(fields)
+        self.columns = tuple(columns)
+
+
+_tables = {}
+_layouts = {}
+
+
+def _get_table(factors: Optional[Tuple[float, ...]], quantum: Optional[Decimal]) -> _DecimalTable:
+    # Decimal("1.0") == Decimal("1.000"), so the quantum is keyed by its string form
+    key = (factors, str(quantum))
+    table = _tables.get(key)
+    if table is None:
+        table = _tables[key] = _DecimalTable(factors, quantum)
+    return table
+
+
+def _get_layout(flags: int, feature: Optional[BodyCompositionFeature]) -> _Layout:
+    if feature is None:
+        key = flags
+    else:
+        key = (
+            flags,
+            feature.get_weight_measurement_resolution_kg(),
+            feature.get_weight_measurement_resolution_lb(),
+            feature.get_height_measurement_resolution_m(),
+            feature.get_height_measurement_resolution_in(),
+        )
+    layout = _layouts.get(key)
+    if layout is None:
+        if flags & Flag.ImperialUnit:
+            weight_resolution = (
+                feature.get_weight_measurement_resolution_lb() if feature else OmronMeasurementWS.WEIGHT_RESOLUTION_LB_DEFAULT
+            )
+            height_resolution = (
+                feature.get_height_measurement_resolution_in() if feature else OmronMeasurementWS.HEIGHT_RESOLUTION_IN_DEFAULT
+            )
+        else:
+            weight_resolution = (
+                feature.get_weight_measurement_resolution_kg() if feature else OmronMeasurementWS.WEIGHT_RESOLUTION_KG_DEFAULT
+            )
+            height_resolution = (
+                feature.get_height_measurement_resolution_m() if feature else OmronMeasurementWS.HEIGHT_RESOLUTION_M_DEFAULT
+            )
+        layout = _layouts[key] = _Layout(flags, weight_resolution, height_resolution)
+    return layout
+
+
+# batch decoding
+#
+# decode_many takes a whole notification buffer (records back to back, as collected on the measurement channel)
+# and returns one column per field. Records are grouped by their flags words and every group is decoded with a
+# numpy view over the buffer. Without numpy the object path is used.
+
+# column name -> attribute, in packet order
+COLUMNS = {attr[1:]: attr for attr in dict.fromkeys(field[2] for field in _FIELDS)}
+_SCALED = {field[2] for field in _FIELDS if field[3] is not None and field[3] != _TIMESTAMP}
+_TIMESTAMP_PARTS = ("_year", "_month", "_day", "_hour", "_minute", "_second")
+_TIMESTAMP_DTYPE = tuple(zip(_TIMESTAMP_PARTS, ("<u2", "u1", "u1", "u1", "u1", "u1"), (0, 2, 3, 4, 5, 6)))
+
+
+def frame_packets(
+    packets: Iterator[Optional[bytes]],
+    feature: Optional[BodyCompositionFeature] = None,
+    assembler: Optional["FrameAssembler"] = None,
+) -> Iterator[Tuple[memoryview, Optional[memoryview]]]:
+    # yields (data1, data2) for every record in a sequence of notifications, framed like OmronBLE does while
+    # receiving (see FrameAssembler). None in the sequence marks a break (e.g. another transfer).
+    # Pass an assembler (instead of the feature) to read its dropped count afterwards.
+    if assembler is None:
+        assembler = FrameAssembler(feature)
+    for packet in packets:
+        if packet is None:
+            assembler.reset()
+        else:
+            yield from assembler.feed(packet)
+    assembler.reset()
+
+
+class FrameAssembler:
+    # frames the notifications of the measurement channel into records
+    # A notification holds one or more whole packets back to back, the size of each packet follows from its flags
+    # word (see _Layout). The packets are memoryview slices of the notification, nothing is copied or buffered
+    # except the first packet of a multiple packet measurement, which is paired with the next packet.
+    # Packets are never joined across notifications, so a truncated packet costs only itself. A waiting first packet
+    # is dropped when the next notification does not hold its second packet (same sequence number).
+
+    __slots__ = ("feature", "first", "dropped")
+
+    def __init__(self, feature: Optional[BodyCompositionFeature] = None):
+        self.feature = feature
+        self.first = None
+        # packets that could not be framed (truncated, unknown flags, or unpaired)
+        self.dropped = 0
+
+    def reset(self):
+        # a break in the notifications, a first packet waiting for its second one is dropped
+        if self.first is not None:
+            self.dropped += 1
+            self.first = None
+
+    def feed(self, data: bytes) -> List[Tuple[memoryview, Optional[memoryview]]]:
+        # returns the records completed by the notification, data must not change afterwards
+        view = memoryview(data)
+        size = len(view)
+        records = []
+        offset = 0
+        if self.first is not None:
+            second = _packet_at(view, 0, self.feature)
+            if second is not None and _same_record(self.first, view):
+                records.append((self.first, view[: second.size]))
+                offset = second.size
+            else:
+                # the second packet was lost, the notification starts a new record
+                self.dropped += 1
+            self.first = None
+        while offset < size:
+            record = _record_at(view, offset, self.feature)
+            if record is None:
+                first = _packet_at(view, offset, self.feature)
+                if first is None:
+                    # padding, a truncated packet or a packet type we do not know, nothing after it can be framed
+                    self.dropped += 1
+                    break
+                if offset + first.size == size:
+                    # the second packet is the next notification
+                    self.first = view[offset:size]
+                    break
+                # the second packet is missing or belongs to another record, it is framed on its own
+                self.dropped += 1
+                offset += first.size
+                continue
+            first, second, end = record
+            middle = offset + first.size
+            records.append((view[offset:middle], view[middle:end] if second else None))
+            offset = end
+        return records
+
+
+def _packet_at(buffer: bytes, offset: int, feature: Optional[BodyCompositionFeature]) -> Optional[_Layout]:
+    # layout of the whole packet at offset, None for padding, a truncated packet or a packet type we do not know
+    if offset + 3 > len(buffer):
+        return None
+    flags = int.from_bytes(buffer[offset : offset + 3], byteorder="little")
+    if flags & ~_KNOWN_FLAGS or not flags & _FIELD_FLAGS:
+        return None
+    layout = _get_layout(flags, feature)
+    if offset + layout.size > len(buffer):
+        return None
+    return layout
+
+
+def _record_at(buffer: bytes, offset: int, feature: Optional[BodyCompositionFeature]):
+    # (first, second or None, end) of the record at offset, None where the records end
+    # the framing rules of FrameAssembler and decode_many
+    first = _packet_at(buffer, offset, feature)
+    if first is None:
+        return None
+    end = offset + first.size
+    second = None
+    if first.flags & Flag.MultiplePacketMeasurement:
+        second = _packet_at(buffer, end, feature)
+        if second is None or not _same_record(buffer[offset : offset + 5], buffer[end : end + 5]):
+            return None
+        end += second.size
+    return first, second, end
+
+
+def _same_record(first: bytes, second: bytes) -> bool:
+    # the scale sends the sequence number in both packets of a record, packets with different ones are not paired
+    flags = int.from_bytes(first[0:3], byteorder="little") & int.from_bytes(second[0:3], byteorder="little")
+    return not flags & Flag.SequenceNumberPresent or first[3:5] == second[3:5]
+
+
+def decode_many(buffer: bytes, feature: Optional[BodyCompositionFeature] = None) -> Dict[str, object]:
+    # Returns a dict of columns named like the measurements table plus "ImperialUnit". With numpy, scaled values
+    # are float64 arrays (NaN where absent) and the others int64 arrays (-1 where absent). Without numpy the
+    # columns are lists holding the same values as the OmronMeasurementWS attributes (None where absent).
+    if _load_numpy() is None:
+        return _decode_many_objects(buffer, feature)
+
+    groups = {}
+    count = 0
+    for offset, first, second, run in _iter_runs(buffer, feature):
+        groups.setdefault((first, second), []).append((count, offset, run))
+        count += run
+
+    columns = {"ImperialUnit": np.zeros(count, dtype=bool)}
+    for name, attr in COLUMNS.items():
+        if attr in _SCALED:
+            columns[name] = np.full(count, np.nan)
+        else:
+            columns[name] = np.full(count, -1, dtype=np.int64)
+
+    for (first, second), runs in groups.items():
+        dtype = _record_dtype(first, second)
+        if len(runs) == 1:
+            row, offset, run = runs[0]
+            rows = slice(row, row + run)
+            records = np.frombuffer(buffer, dtype=dtype, count=run, offset=offset)
+        else:
+            rows = np.concatenate([np.arange(row, row + run) for row, _, run in runs])
+            records = np.concatenate(
+                [np.frombuffer(buffer, dtype=dtype, count=run, offset=offset) for _, offset, run in runs]
+            )
+        # like the object path, the units follow the last packet of the record
+        columns["ImperialUnit"][rows] = bool((second or first).flags & Flag.ImperialUnit)
+        packets = [(first, "p0_")] if second is None else [(first, "p0_"), (second, "p1_")]
+        for layout, prefix in packets:
+            for attr, _, fmt, table in layout.columns:
+                name = attr[1:]
+                if table is None:
+                    columns[name][rows] = _timestamps(records, prefix + name)
+                    continue
+                raw = records[prefix + name]
+                if table.factors is None:
+                    columns[name][rows] = raw
+                else:
+                    # run every distinct raw value through the same table as the object path
+                    unique, inverse = np.unique(raw, return_inverse=True)
+                    lut = np.fromiter((float(table[int(value)]) for value in unique), np.float64, len(unique))
+                    columns[name][rows] = lut[inverse]
+    return columns
+
+
+def _record_dtype(first: _Layout, second: Optional[_Layout]):
+    names, formats, offsets = [], [], []
+    packets = [(first, "p0_", 0)] if second is None else [(first, "p0_", 0), (second, "p1_", first.size)]
+    for layout, prefix, base in packets:
+        for attr, offset, fmt, table in layout.columns:
+            if table is None:
+                for part, part_fmt, part_offset in _TIMESTAMP_DTYPE:
+                    names.append(prefix + attr[1:] + part)
+                    formats.append(part_fmt)
+                    offsets.append(base + offset + part_offset)
+            else:
+                names.append(prefix + attr[1:])
+                formats.append("<u2" if fmt == "H" else "u1")
+                offsets.append(base + offset)
+    itemsize = first.size + (second.size if second else 0)
+    return np.dtype({"names": names, "formats": formats, "offsets": offsets, "itemsize": itemsize})
+
+
+def _load_numpy():
+    global np, _numpy_loaded
+    if not _numpy_loaded:
+        _numpy_loaded = True
+        try:
+            import numpy
+        except ImportError:
+            numpy = None
+        np = numpy
+    return np
+
+
+def _iter_runs(buffer: bytes, feature: Optional[BodyCompositionFeature]):
+    # yields (offset, first, second, count) for runs of consecutive records (see _record_at) sharing the
+    # same flags words. The run length is found with vectorised compares over a growing window.
+    data = np.frombuffer(buffer, dtype=np.uint8)
+    size = len(buffer)
+    offset = 0
+    record = _record_at(buffer, offset, feature)
+    while record is not None:
+        first, second, end = record
+        stride = end - offset
+        available = (size - offset) // stride
+        run = 1
+        window = 16
+        while run < available:
+            end = min(available, run + window)
+            records = data[offset + run * stride : offset + end * stride].reshape(end - run, stride)
+            same = (records[:, 0:3] == data[offset : offset + 3]).all(axis=1)
+            if second:
+                flags2 = slice(first.size, first.size + 3)
+                same &= (records[:, flags2] == data[offset + first.size : offset + first.size + 3]).all(axis=1)
+            if not same.all():
+                run += int(np.argmin(same))
+                break
+            run = end
+            window *= 2
+        yield offset, first, second, run
+        offset += run * stride
+        record = _record_at(buffer, offset, feature)
+
+
+def _timestamps(records, name: str):
+    year, month, day, hour, minute, second = (records[name + part].astype(np.int64) for part in _TIMESTAMP_PARTS)
+    leap = ((year % 4 == 0) & (year % 100 != 0)) | (year % 400 == 0)
+    month_index = np.clip(month - 1, 0, 11)
+    days_in_month = np.array([31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31])[month_index] + ((month == 2) & leap)
+    valid = (
+        (year >= 1) & (month >= 1) & (month <= 12) & (day >= 1) & (day <= days_in_month)
+        & (hour < 24) & (minute < 60) & (second < 60)
+    )
+    if not valid.all():
+        raise ValueError(f"invalid timestamp in record {int(np.argmin(valid))} of group {name}")
+    # days from civil, see http://howardhinnant.github.io/date_algorithms.html
+    y = year - (month <= 2)
+    era = y // 400
+    yoe = y - era * 400
+    doy = (153 * ((month + 9) % 12) + 2) // 5 + day - 1
+    doe = yoe * 365 + yoe // 4 - yoe // 100 + doy
+    days = era * 146097 + doe - 719468
+    return days * 86400 + hour * 3600 + minute * 60 + second
+
+
+def _decode_many_objects(buffer: bytes, feature: Optional[BodyCompositionFeature]) -> Dict[str, list]:
+    columns = {"ImperialUnit": []}
+    columns.update((name, []) for name in COLUMNS)
+    for data1, data2 in frame_packets([buffer], feature):
+        measurement = OmronMeasurementWS(data1=data1, data2=data2, feature=feature)
+        columns["ImperialUnit"].append(measurement.mWeightUnit == OmronMeasurementWS.WEIGHT_UNIT_POUND)
+        for name, attr in COLUMNS.items():
+            value = getattr(measurement, attr)
+            if value is not None and name != "TimeStamp":
+                value = float(value) if attr in _SCALED else int(value)
+            columns[name].append(value)
+    return columns
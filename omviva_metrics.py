@@ -0,0 +1,143 @@
+# timing histograms and counters for the phases of a sync
+#
+# Everything is kept in the module level registry `metrics`, which the other modules update:
+#
+#   with metrics.span("connect"):
+#       await client.connect()
+#   metrics.count("bytes_received", len(data))
+#
+# The values are exposed in the Prometheus text format (serve, METRICS_PORT in config.json) and can be published as
+# a JSON summary with estimated percentiles (summary, see publish_metrics in omviva.py).
+# It only depends on the standard library.
+
+import asyncio
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+# upper bounds in seconds, from a single send round trip up to a complete transfer
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+PREFIX = "omviva"
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class Histogram:
+    __slots__ = ("buckets", "counts", "count", "sum")
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        # counts[i] observations <= buckets[i] (not cumulative), the last entry is +Inf
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        # estimated like PromQL histogram_quantile, by linear interpolation within the bucket
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        cumulative = 0
+        for index, bucket_count in enumerate(self.counts):
+            if cumulative + bucket_count >= rank and bucket_count:
+                if index == len(self.buckets):
+                    return self.buckets[-1]
+                lower = self.buckets[index - 1] if index else 0.0
+                return lower + (self.buckets[index] - lower) * (rank - cumulative) / bucket_count
+            cumulative += bucket_count
+        return self.buckets[-1]
+
+
+class Metrics:
+    def __init__(self):
+        # phase -> Histogram of its durations in seconds
+        self.phases = {}
+        # name -> total
+        self.counters = {}
+
+    @contextmanager
+    def span(self, phase):
+        # times the block, also when it raises (e.g. a connect timeout)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(phase, time.perf_counter() - start)
+
+    def observe(self, phase, seconds):
+        histogram = self.phases.get(phase)
+        if histogram is None:
+            histogram = self.phases[phase] = Histogram()
+        histogram.observe(seconds)
+
+    def count(self, name, amount=1):
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    def render(self):
+        # Prometheus text exposition format
+        lines = []
+        if self.phases:
+            name = f"{PREFIX}_phase_seconds"
+            lines.append(f"# HELP {name} Time spent in each phase of a sync.")
+            lines.append(f"# TYPE {name} histogram")
+            for phase, histogram in sorted(self.phases.items()):
+                cumulative = 0
+                for bound, bucket_count in zip(histogram.buckets + ("+Inf",), histogram.counts):
+                    cumulative += bucket_count
+                    lines.append(f'{name}_bucket{{phase="{phase}",le="{bound}"}} {cumulative}')
+                lines.append(f'{name}_sum{{phase="{phase}"}} {histogram.sum}')
+                lines.append(f'{name}_count{{phase="{phase}"}} {histogram.count}')
+        for counter, value in sorted(self.counters.items()):
+            name = f"{PREFIX}_{counter}_total"
+            lines.append(f"# TYPE {name} counter")
+            lines.append(f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+    def summary(self):
+        # JSON friendly view with count, sum and estimated percentiles per phase
+        phases = {}
+        for phase, histogram in self.phases.items():
+            phases[phase] = {
+                "count": histogram.count,
+                "sum": round(histogram.sum, 6),
+                "p50": histogram.quantile(0.5),
+                "p95": histogram.quantile(0.95),
+                "p99": histogram.quantile(0.99),
+            }
+        return {"phases": phases, "counters": dict(self.counters)}
+
+    async def serve(self, port, host="0.0.0.0"):
+        # minimal HTTP server answering GET /metrics, runs until cancelled
+        server = await asyncio.start_server(self._handle, host, port)
+        async with server:
+            await server.serve_forever()
+
+    async def _handle(self, reader, writer):
+        try:
+            request = await asyncio.wait_for(reader.readline(), timeout=5)
+            # the headers are not needed
+            while (await asyncio.wait_for(reader.readline(), timeout=5)).strip():
+                pass
+            parts = request.decode("latin-1").split()
+            if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] == "/metrics":
+                status, body = "200 OK", self.render().encode("utf-8")
+            else:
+                status, body = "404 Not Found", b"not found\n"
+            writer.write(
+                f"HTTP/1.0 {status}\r\nContent-Type: {CONTENT_TYPE}\r\nContent-Length: {len(body)}\r\n\r\n".encode(
+                    "latin-1"
+                )
+                + body
+            )
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+
+metrics = Metrics()
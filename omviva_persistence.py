@@ -1,115 +1,749 @@
-from omviva_measurement import OmronMeasurementWS
+from omviva_measurement import OmronMeasurementWS, BodyCompositionFeature, FrameAssembler, frame_packets
+from omviva_metrics import metrics
 import sqlite3
-import decimal
+import struct
 import time
 
-D = decimal.Decimal
+SECONDS_PER_DAY = 86400
+
+# measurements columns in the order of measurement_row
+MEASUREMENT_COLUMNS = (
+    "SequenceNumber",
+    "TimeStamp",
+    "UserID",
+    "Weight",
+    "BMI",
+    "Height",
+    "BodyFatPercentage",
+    "BasalMetabolism",
+    "SkeletalMusclePercentage",
+    "VisceralFatLevel",
+    "BodyAge",
+    "MusclePercentage",
+    "MuscleMass",
+    "FatFreeMass",
+    "SoftLeanMass",
+    "BodyWaterMass",
+    "Impedance",
+    "BodyFatPercentageStageEvaluation",
+    "SkeletalMusclePercentageStageEvaluation",
+    "VisceralFatLevelStageEvaluation",
+)
+
+# measurements_fixed stores the values as sent by the scale, as INTEGER in its units and resolution, together with
+# the unit and the resolution codes of the BodyCompositionFeature. These columns are scaled by the measurements
+# view: thousandths (e.g. grams for a weight in kg) per raw unit, "weight" and "height" depend on the unit and code.
+SCALED_COLUMNS = {
+    "Weight": "weight",
+    "BMI": 100,
+    "Height": "height",
+    "BodyFatPercentage": 1,
+    "SkeletalMusclePercentage": 1,
+    "VisceralFatLevel": 500,
+    "MusclePercentage": 1,
+    "MuscleMass": "weight",
+    "FatFreeMass": "weight",
+    "SoftLeanMass": "weight",
+    "BodyWaterMass": "weight",
+    "Impedance": 100,
+}
+FIXED_POINT = 1000
+# measurements_fixed columns in the order of measurement_row
+STORED_COLUMNS = MEASUREMENT_COLUMNS + ("ImperialUnit", "WeightResolution", "HeightResolution")
+
+
+def _resolution(code, resolutions):
+    # SQL for the resolution in thousandths of the code column
+    cases = " ".join(
+        f"WHEN {index} THEN {round(resolution * FIXED_POINT)}" for index, resolution in enumerate(resolutions)
+    )
+    return f"CASE {code} {cases} END"
+
+
+def _factor(column, row):
+    # SQL for the thousandths per raw unit of a measurements_fixed column (of row, a table name, NEW or OLD)
+    factor = SCALED_COLUMNS[column]
+    if factor == "weight":
+        kg = _resolution(f"{row}.WeightResolution", BodyCompositionFeature.WEIGHT_RESOLUTION_KG)
+        lb = _resolution(f"{row}.WeightResolution", BodyCompositionFeature.WEIGHT_RESOLUTION_LB)
+        factor = f"(CASE WHEN {row}.ImperialUnit THEN {lb} ELSE {kg} END)"
+    elif factor == "height":
+        m = _resolution(f"{row}.HeightResolution", BodyCompositionFeature.HEIGHT_RESOLUTION_M)
+        inch = _resolution(f"{row}.HeightResolution", BodyCompositionFeature.HEIGHT_RESOLUTION_IN)
+        factor = f"(CASE WHEN {row}.ImperialUnit THEN {inch} ELSE {m} END)"
+    return str(factor)
+
+
+def _thousandths(column, row):
+    # SQL for the exact value of a measurements_fixed column in thousandths
+    return f"{row}.{column} * {_factor(column, row)}"
+
+
+# select list of MEASUREMENT_COLUMNS from measurements_fixed with the scaled values
+MEASUREMENT_SELECT = ", ".join(
+    f"{_thousandths(column, 'measurements_fixed')} / {FIXED_POINT}.0 AS {column}" if column in SCALED_COLUMNS
+    else column
+    for column in MEASUREMENT_COLUMNS
+)
+
+# rollup table -> period of a measurements row, weeks start on Monday (day 0, 1970-01-01, was a Thursday)
+ROLLUPS = {
+    "daily": "{row}.TimeStamp / 86400",
+    "weekly": "({row}.TimeStamp / 86400 + 3) / 7",
+}
+# averaged measurements columns -> rollup column prefix
+ROLLUP_VALUES = {"Weight": "Weight", "BMI": "BMI", "BodyFatPercentage": "BodyFat"}
+
+
+def _rollup_table(table):
+    sums = "".join(f"{prefix}Sum REAL, {prefix}Count INTEGER, " for prefix in ROLLUP_VALUES.values())
+    return f"""
+        CREATE TABLE IF NOT EXISTS {table} (
+            UserID INTEGER, Period INTEGER, Count INTEGER, {sums}
+            PRIMARY KEY (UserID, Period)
+        )
+        """
+
+
+def _column(column, row):
+    return f"{row}.{column}"
+
+
+def _rollup_add(table, row, sign, value=_column):
+    # adds (sign 1) or removes (sign -1) the measurements row (NEW or OLD in a trigger) to its rollup period
+    # value(column, row) is the SQL for the summed value of a column
+    columns = ["UserID", "Period", "Count"]
+    values = [f"{row}.UserID", ROLLUPS[table].format(row=row), str(sign)]
+    for column, prefix in ROLLUP_VALUES.items():
+        columns += [f"{prefix}Sum", f"{prefix}Count"]
+        values += [f"{sign} * IFNULL({value(column, row)}, 0)", f"{sign} * ({row}.{column} IS NOT NULL)"]
+    updates = ", ".join(f"{column} = {column} + excluded.{column}" for column in columns[2:])
+    return (
+        f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join(values)}) "
+        f"ON CONFLICT (UserID, Period) DO UPDATE SET {updates};"
+    )
+
+
+def _rollup_backfill(table, source, value=_column):
+    sums = "".join(f", SUM(IFNULL({value(column, source)}, 0)), COUNT({column})" for column in ROLLUP_VALUES)
+    return f"""
+        INSERT INTO {table}
+        SELECT UserID, {ROLLUPS[table].format(row=source)}, COUNT(*){sums} FROM {source} GROUP BY 1, 2
+        """
+
+
+def _rollup_triggers(table, source, value=_column):
+    # keeps the rollup up to date in the transaction that changes the source table
+    cleanup = f"DELETE FROM {table} WHERE Count = 0;"
+    return [
+        f"""
+        CREATE TRIGGER IF NOT EXISTS {table}_insert AFTER INSERT ON {source} BEGIN
+            {_rollup_add(table, "NEW", 1, value)}
+        END
+        """,
+        f"""
+        CREATE TRIGGER IF NOT EXISTS {table}_update AFTER UPDATE ON {source} BEGIN
+            {_rollup_add(table, "OLD", -1, value)}
+            {_rollup_add(table, "NEW", 1, value)}
+            {cleanup}
+        END
+        """,
+        f"""
+        CREATE TRIGGER IF NOT EXISTS {table}_delete AFTER DELETE ON {source} BEGIN
+            {_rollup_add(table, "OLD", -1, value)}
+            {cleanup}
+        END
+        """,
+    ]
+
+
+# schema migrations, MIGRATIONS[n] upgrades a database from user_version n to n + 1
+# databases created before versioning have user_version 0 and are upgraded in place
+MIGRATIONS = [
+    [
+        """
+        CREATE TABLE IF NOT EXISTS measurements (
+            SequenceNumber INTEGER,
+            TimeStamp INTEGER,
+            UserID INTEGER,
+            Weight REAL,
+            BMI REAL,
+            Height REAL,
+            BodyFatPercentage REAL,
+            BasalMetabolism INTEGER,
+            SkeletalMusclePercentage REAL,
+            VisceralFatLevel REAL,
+            BodyAge INTEGER
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS syncs (
+            TimeStamp INTEGER,
+            UserID INTEGER
+        )
+        """,
+        # one row per user and sequence number, see persist_many
+        """
+        DELETE FROM measurements WHERE rowid NOT IN (
+            SELECT MIN(rowid) FROM measurements GROUP BY UserID, SequenceNumber
+        )
+        """,
+        """
+        CREATE UNIQUE INDEX IF NOT EXISTS measurements_user_sequence ON measurements (UserID, SequenceNumber)
+        """,
+    ],
+    [
+        # the syncs in time order, for reading the sync log
+        """
+        CREATE INDEX IF NOT EXISTS syncs_timestamp ON syncs (TimeStamp, UserID)
+        """,
+    ],
+    [
+        # per user sync state for the scheduler in omviva.py
+        """
+        CREATE TABLE IF NOT EXISTS users (
+            UserID INTEGER PRIMARY KEY,
+            LastCount INTEGER,
+            LastSequence INTEGER,
+            LastSync INTEGER,
+            LastCheck INTEGER
+        )
+        """,
+        """
+        INSERT OR IGNORE INTO users (UserID, LastSequence, LastSync)
+        SELECT UserID, MAX(SequenceNumber), (SELECT MAX(TimeStamp) FROM syncs WHERE syncs.UserID = measurements.UserID)
+        FROM measurements GROUP BY UserID
+        """,
+    ],
+    [
+        # last rowids shipped to each remote, see omviva_replication.py
+        """
+        CREATE TABLE IF NOT EXISTS replication (
+            Remote TEXT PRIMARY KEY,
+            MeasurementsRowid INTEGER,
+            SyncsRowid INTEGER
+        )
+        """,
+    ],
+    [
+        # fields that were decoded but not stored before, filled for old rows by VivaPersistence.reprocess
+        "ALTER TABLE measurements ADD COLUMN MusclePercentage REAL",
+        "ALTER TABLE measurements ADD COLUMN MuscleMass REAL",
+        "ALTER TABLE measurements ADD COLUMN FatFreeMass REAL",
+        "ALTER TABLE measurements ADD COLUMN SoftLeanMass REAL",
+        "ALTER TABLE measurements ADD COLUMN BodyWaterMass REAL",
+        "ALTER TABLE measurements ADD COLUMN Impedance REAL",
+        "ALTER TABLE measurements ADD COLUMN BodyFatPercentageStageEvaluation INTEGER",
+        "ALTER TABLE measurements ADD COLUMN SkeletalMusclePercentageStageEvaluation INTEGER",
+        "ALTER TABLE measurements ADD COLUMN VisceralFatLevelStageEvaluation INTEGER",
+        # append only archive of every notification received from the scale
+        """
+        CREATE TABLE IF NOT EXISTS notifications (
+            TimeStamp REAL,
+            Channel TEXT,
+            Data BLOB
+        )
+        """,
+    ],
+    [
+        # read side, see get_measurements, get_rollup and get_moving_averages
+        """
+        CREATE INDEX IF NOT EXISTS measurements_user_timestamp ON measurements (UserID, TimeStamp)
+        """,
+        *[_rollup_table(table) for table in ROLLUPS],
+        *[_rollup_backfill(table, "measurements") for table in ROLLUPS],
+        *[trigger for table in ROLLUPS for trigger in _rollup_triggers(table, "measurements")],
+    ],
+    [
+        # measurements waiting to be published to MQTT, see persist_many and MqttPublisher in omviva.py
+        """
+        CREATE TABLE IF NOT EXISTS outbox (
+            MeasurementRowid INTEGER PRIMARY KEY,
+            Delivered INTEGER
+        )
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS outbox_pending ON outbox (MeasurementRowid) WHERE Delivered IS NULL
+        """,
+    ],
+    [
+        # MAC of the scale a notification came from, NULL for the single scale setups before
+        "ALTER TABLE notifications ADD COLUMN Device TEXT",
+    ],
+    [
+        # fixed-point storage with the decimal values in thousandths, the rowids are kept for the outbox and the
+        # replication watermarks
+        f"""
+        CREATE TABLE measurements_fixed ({', '.join(f"{column} INTEGER" for column in MEASUREMENT_COLUMNS)})
+        """,
+        f"""
+        INSERT INTO measurements_fixed (rowid, {', '.join(MEASUREMENT_COLUMNS)})
+        SELECT rowid, {', '.join(
+            f"CAST(ROUND({column} * {FIXED_POINT}) AS INTEGER)" if column in SCALED_COLUMNS else column
+            for column in MEASUREMENT_COLUMNS
+        )} FROM measurements
+        """,
+        # also drops the rollup triggers and the indexes
+        "DROP TABLE measurements",
+        """
+        CREATE UNIQUE INDEX measurements_fixed_user_sequence ON measurements_fixed (UserID, SequenceNumber)
+        """,
+        """
+        CREATE INDEX measurements_fixed_user_timestamp ON measurements_fixed (UserID, TimeStamp)
+        """,
+        # for the existing queries on the copied database
+        f"""
+        CREATE VIEW measurements AS SELECT {', '.join(
+            f"{column} / {FIXED_POINT}.0 AS {column}" if column in SCALED_COLUMNS else column
+            for column in MEASUREMENT_COLUMNS
+        )} FROM measurements_fixed
+        """,
+        # the rollups now sum thousandths
+        *[f"DELETE FROM {table}" for table in ROLLUPS],
+        *[_rollup_backfill(table, "measurements_fixed") for table in ROLLUPS],
+        *[trigger for table in ROLLUPS for trigger in _rollup_triggers(table, "measurements_fixed")],
+    ],
+    [
+        # raw values with their unit and resolution codes, see SCALED_COLUMNS, the view and the rollups scale them
+        *[f"DROP TRIGGER {table}_{event}" for table in ROLLUPS for event in ("insert", "update", "delete")],
+        "DROP VIEW measurements",
+        *[f"ALTER TABLE measurements_fixed ADD COLUMN {column} INTEGER" for column in STORED_COLUMNS[-3:]],
+        # the unit and resolutions of the stored rows are not known, they are stored as metric with the default
+        # resolutions, which hold every stored value exactly (reprocess decodes the archived notifications again)
+        "UPDATE measurements_fixed SET ImperialUnit = 0, WeightResolution = 0, HeightResolution = 0",
+        f"""
+        UPDATE measurements_fixed SET {', '.join(
+            f"{column} = CAST(ROUND({column} * 1.0 / {_factor(column, 'measurements_fixed')}) AS INTEGER)"
+            for column in SCALED_COLUMNS
+        )}
+        """,
+        f"""
+        CREATE VIEW measurements AS SELECT {MEASUREMENT_SELECT} FROM measurements_fixed
+        """,
+        *[trigger for table in ROLLUPS for trigger in _rollup_triggers(table, "measurements_fixed", _thousandths)],
+    ],
+]
+
+SCHEMA_VERSION = len(MIGRATIONS)
+
+INSERT_MEASUREMENT = (
+    f"INSERT OR IGNORE INTO measurements_fixed ({', '.join(STORED_COLUMNS)}) "
+    f"VALUES ({', '.join('?' * len(STORED_COLUMNS))})"
+)
+
+# like INSERT_MEASUREMENT, but rows already stored for (UserID, SequenceNumber) are overwritten
+UPSERT_MEASUREMENT = (
+    f"INSERT INTO measurements_fixed ({', '.join(STORED_COLUMNS)}) "
+    f"VALUES ({', '.join('?' * len(STORED_COLUMNS))}) "
+    "ON CONFLICT (UserID, SequenceNumber) DO UPDATE SET "
+    + ", ".join(
+        f"{column} = excluded.{column}" for column in STORED_COLUMNS if column not in ("UserID", "SequenceNumber")
+    )
+)
+
+# delivered outbox rows are kept this long
+OUTBOX_RETENTION_SECONDS = 7 * SECONDS_PER_DAY
+
+# rows per fetchmany call in iter_measurements
+EXPORT_CHUNK_SIZE = 1000
+
+# archived notifications read per fetchmany call and measurements written per executemany call in reprocess
+REPROCESS_BATCH_SIZE = 500
 
 
 class VivaPersistence:
-    def __init__(self, db_name="viva_measurements.db"):
+    def __init__(self, db_name="viva_measurements.db", outbox=False):
         self.db_name = db_name
+        # with outbox every new measurement is queued for publishing in the transaction that stores it
+        self.outbox = outbox
         self.conn = sqlite3.connect(self.db_name)
         self.cursor = self.conn.cursor()
+        self.cursor.execute("PRAGMA journal_mode = WAL")
+        # with WAL, NORMAL only syncs on checkpoints and is still safe against corruption
+        self.cursor.execute("PRAGMA synchronous = NORMAL")
+        self.cursor.execute("PRAGMA cache_size = -4096")
         self.create_database()
+        # notifications waiting to be written with the next transaction, see archive_notification
+        self.pending_notifications = []
 
     def create_database(self):
-        self.cursor.execute("""
-            CREATE TABLE IF NOT EXISTS measurements (
-                SequenceNumber INTEGER,
-                TimeStamp INTEGER,
-                UserID INTEGER,
-                Weight REAL,
-                BMI REAL,
-                Height REAL,
-                BodyFatPercentage REAL,
-                BasalMetabolism INTEGER,
-                SkeletalMusclePercentage REAL,
-                VisceralFatLevel REAL,
-                BodyAge INTEGER
-            )
-        """)
+        self.cursor.execute("PRAGMA user_version")
+        version = self.cursor.fetchone()[0]
+        while version < SCHEMA_VERSION:
+            self.cursor.execute("BEGIN")
+            try:
+                for statement in MIGRATIONS[version]:
+                    self.cursor.execute(statement)
+                version += 1
+                self.cursor.execute(f"PRAGMA user_version = {version}")
+                self.conn.commit()
+            except Exception:
+                self.conn.rollback()
+                raise
 
-        self.cursor.execute("""
-            CREATE TABLE IF NOT EXISTS syncs (
-            TimeStamp INTEGER,
-            UserID INTEGER
-            )
-        """)
+    def store_success(self, user_id):
+        now = int(time.time())
+        self.cursor.execute(
+            """
+            INSERT INTO syncs (TimeStamp, UserID) VALUES (?, ?)
+        """,
+            (now, user_id),
+        )
+        self.cursor.execute(
+            """
+            INSERT INTO users (UserID, LastCount, LastSequence, LastSync, LastCheck)
+            VALUES (?, 0, (SELECT MAX(SequenceNumber) FROM measurements_fixed WHERE UserID = ?), ?, ?)
+            ON CONFLICT (UserID) DO UPDATE SET
+                LastCount = 0, LastSequence = excluded.LastSequence, LastSync = excluded.LastSync, LastCheck = excluded.LastCheck
+        """,
+            (user_id, user_id, now, now),
+        )
         self.conn.commit()
 
-    def get_last_sync_user(self):
+    def get_user_states(self):
+        # UserID -> (LastCount, LastSequence, LastSync, LastCheck)
         self.cursor.execute(
             """
-            SELECT MAX(TimeStamp), UserID FROM syncs
+            SELECT UserID, LastCount, LastSequence, LastSync, LastCheck FROM users
         """
         )
-        result = self.cursor.fetchone()
-        return result
+        return {row[0]: row[1:] for row in self.cursor.fetchall()}
 
-    def store_success(self, user_id):
+    def store_user_count(self, user_id, count, last_sequence):
+        # count is the number of records after last_sequence reported by the scale, None if unknown
         self.cursor.execute(
             """
-            INSERT INTO syncs (TimeStamp, UserID) VALUES (?, ?)
+            INSERT INTO users (UserID, LastCount, LastSequence, LastCheck) VALUES (?, ?, ?, ?)
+            ON CONFLICT (UserID) DO UPDATE SET
+                LastCount = excluded.LastCount, LastSequence = excluded.LastSequence, LastCheck = excluded.LastCheck
         """,
-            (int(time.time()), user_id),
+            (user_id, count, last_sequence, int(time.time())),
         )
         self.conn.commit()
 
-    def get_highest_sequence_number_for_user(self, user_id):
+    def get_measurements(self, user_id, start=None, end=None):
+        # measurements of the user with start <= TimeStamp < end (epoch seconds, None for open), oldest first
+        # rows are dicts keyed by the MEASUREMENT_COLUMNS
         self.cursor.execute(
-            """
-            SELECT MAX(SequenceNumber) FROM measurements WHERE UserID = ?
+            f"""
+            SELECT {MEASUREMENT_SELECT} FROM measurements_fixed
+            WHERE UserID = ? AND TimeStamp >= ? AND TimeStamp < ? ORDER BY TimeStamp
+        """,
+            (user_id, -1 if start is None else start, 1 << 62 if end is None else end),
+        )
+        return [dict(zip(MEASUREMENT_COLUMNS, row)) for row in self.cursor.fetchall()]
+
+    def get_latest(self, user_id):
+        # the most recent measurement of the user as a dict, None if there is none
+        self.cursor.execute(
+            f"""
+            SELECT {MEASUREMENT_SELECT} FROM measurements_fixed WHERE UserID = ? ORDER BY TimeStamp DESC LIMIT 1
         """,
             (user_id,),
         )
-        result = self.cursor.fetchone()[0]
-        return result
+        row = self.cursor.fetchone()
+        return None if row is None else dict(zip(MEASUREMENT_COLUMNS, row))
 
-    def persist_measurement(self, measurement):
-        sqlite3.register_adapter(D, adapt_decimal)
-        sqlite3.register_converter("decimal", convert_decimal)
+    def get_rollup(self, user_id, table="daily", start=None, end=None):
+        # [(first second of the period, measurements, average weight, BMI and body fat), ...] for the days or weeks
+        # (table "daily" or "weekly") overlapping start <= TimeStamp < end, None averages for values never measured
+        if table not in ROLLUPS:
+            raise ValueError(f"Unknown rollup {table}")
+        averages = ", ".join(
+            f"{prefix}Sum / {FIXED_POINT}.0 / NULLIF({prefix}Count, 0)" for prefix in ROLLUP_VALUES.values()
+        )
+        self.cursor.execute(
+            f"""
+            SELECT Period, Count, {averages} FROM {table}
+            WHERE UserID = ? AND Period >= ? AND Period <= ? ORDER BY Period
+        """,
+            (user_id, self._period(table, start, -1), self._period(table, end, 1 << 62, last=True)),
+        )
+        return [(self._period_start(table, row[0]),) + row[1:] for row in self.cursor.fetchall()]
+
+    def get_moving_averages(self, user_id, days, start=None, end=None):
+        # [(first second of the day, average weight, BMI and body fat over this and the previous days - 1 days), ...]
+        # for every day with measurements in start <= TimeStamp < end
+        first = self._period("daily", start, -1)
+        window = f"OVER (ORDER BY Period RANGE BETWEEN {int(days) - 1} PRECEDING AND CURRENT ROW)"
+        averages = ", ".join(
+            f"SUM({prefix}Sum) {window} / {FIXED_POINT}.0 / NULLIF(SUM({prefix}Count) {window}, 0)"
+            for prefix in ROLLUP_VALUES.values()
+        )
+        self.cursor.execute(
+            f"""
+            SELECT * FROM (
+                SELECT Period, {averages} FROM daily WHERE UserID = ? AND Period >= ? AND Period <= ?
+            ) WHERE Period >= ? ORDER BY Period
+        """,
+            (user_id, first - int(days) + 1, self._period("daily", end, 1 << 62, last=True), first),
+        )
+        return [(row[0] * SECONDS_PER_DAY,) + row[1:] for row in self.cursor.fetchall()]
+
+    def _period(self, table, timestamp, default, last=False):
+        # period of the timestamp, with last of the period before an (exclusive) end timestamp
+        if timestamp is None:
+            return default
+        day = (int(timestamp) - last) // SECONDS_PER_DAY
+        return day if table == "daily" else (day + 3) // 7
+
+    def _period_start(self, table, period):
+        day = period if table == "daily" else period * 7 - 3
+        return day * SECONDS_PER_DAY
+
+    def iter_measurements(self, user_id=None, start=None, end=None, after_rowid=0, chunk_size=EXPORT_CHUNK_SIZE):
+        # yields (rowid, row) in rowid order, row in the order of MEASUREMENT_COLUMNS, fetched chunk_size rows at a time
+        # so the memory use does not depend on the number of rows
+        conditions = ["rowid > ?"]
+        parameters = [after_rowid]
+        for condition, value in (("UserID = ?", user_id), ("TimeStamp >= ?", start), ("TimeStamp < ?", end)):
+            if value is not None:
+                conditions.append(condition)
+                parameters.append(value)
+        cursor = self.conn.cursor()
+        try:
+            cursor.execute(
+                f"SELECT rowid, {MEASUREMENT_SELECT} FROM measurements_fixed "
+                f"WHERE {' AND '.join(conditions)} ORDER BY rowid",
+                parameters,
+            )
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    return
+                for row in rows:
+                    yield row[0], row[1:]
+        finally:
+            cursor.close()
+
+    def get_checkpoint(self, user_id):
+        # sequence number to resume the transfer of the user after: the checkpoint of persist_many,
+        # or the highest stored sequence number if the user was never checked
         self.cursor.execute(
             """
-            SELECT COUNT(*) FROM measurements WHERE SequenceNumber = ? AND UserID = ?
+            SELECT MAX(
+                IFNULL((SELECT LastSequence FROM users WHERE UserID = ?), 0),
+                IFNULL((SELECT MAX(SequenceNumber) FROM measurements_fixed WHERE UserID = ?), 0)
+            )
         """,
-            (int(measurement.mSequenceNumber), int(measurement.mUserID)),
+            (user_id, user_id),
         )
-        if self.cursor.fetchone()[0] > 0:
+        return self.cursor.fetchone()[0]
+
+    def persist_measurement(self, measurement):
+        inserted, skipped = self.persist_many([measurement])
+        if skipped:
             print(f"{measurement.mSequenceNumber} already exists")
-            return
 
+    def persist_many(self, measurements):
+        # inserts all measurements in one transaction, rows already stored for (UserID, SequenceNumber) are skipped
+        # the same transaction moves the checkpoint of the users (LastSequence) past the batch and lowers their
+        # pending count, so an interrupted transfer resumes after the last committed batch (see get_checkpoint)
+        # returns (inserted, skipped)
+        rows = [measurement_row(measurement) for measurement in measurements]
+        checkpoints = {}
+        for row in rows:
+            sequence, count = checkpoints.get(row[2], (0, 0))
+            checkpoints[row[2]] = (max(sequence, row[0]), count + 1)
+        with metrics.span("persist"), self.conn:
+            self._write_notifications()
+            if self.outbox:
+                self.cursor.execute("SELECT IFNULL(MAX(rowid), 0) FROM measurements_fixed")
+                last_rowid = self.cursor.fetchone()[0]
+            self.cursor.executemany(INSERT_MEASUREMENT, rows)
+            # rowcount does not include the rows changed by the rollup triggers
+            inserted = max(self.cursor.rowcount, 0)
+            if self.outbox and inserted:
+                self.cursor.execute(
+                    "INSERT OR IGNORE INTO outbox (MeasurementRowid) "
+                    "SELECT rowid FROM measurements_fixed WHERE rowid > ?",
+                    (last_rowid,),
+                )
+            self.cursor.executemany(
+                """
+                UPDATE users SET LastSequence = MAX(IFNULL(LastSequence, 0), ?), LastCount = MAX(LastCount - ?, 0)
+                WHERE UserID = ?
+            """,
+                [(sequence, count, user_id) for user_id, (sequence, count) in checkpoints.items()],
+            )
+        metrics.count("records_inserted", inserted)
+        metrics.count("records_skipped", len(rows) - inserted)
+        return inserted, len(rows) - inserted
+
+    def archive_notification(self, timestamp, channel, data, device=None):
+        # called for every notification during a sync (OmronBLE.notification_sink), the notifications are
+        # written together with the next persist_many or by flush_notifications
+        self.pending_notifications.append((timestamp, channel, data, device))
+
+    def flush_notifications(self):
+        if self.pending_notifications:
+            with self.conn:
+                self._write_notifications()
+
+    def _write_notifications(self):
+        if self.pending_notifications:
+            self.cursor.executemany(
+                "INSERT INTO notifications (TimeStamp, Channel, Data, Device) VALUES (?, ?, ?, ?)",
+                self.pending_notifications,
+            )
+            self.pending_notifications = []
+
+    def reprocess(self, features=None, batch_size=REPROCESS_BATCH_SIZE, user_offsets=None):
+        # decodes the archived measurement notifications again and adds or overwrites the measurements,
+        # returns (records stored, records that could not be decoded)
+        # features maps the MAC of a scale to its BodyCompositionFeature (see omviva_profile.py), None for the defaults
+        # user_offsets maps the MAC of a scale to the offset added to its user ids (see Scale in omviva.py)
+        # notifications of other channels separate the transfers, so packets of different transfers are never paired
+        self.flush_notifications()
+        features = features or {}
+        user_offsets = user_offsets or {}
+        self.cursor.execute("SELECT DISTINCT Device FROM notifications")
+        devices = [row[0] for row in self.cursor.fetchall()]
+        notifications = self.conn.cursor()
+
+        def packets(device):
+            notifications.execute("SELECT Channel, Data FROM notifications WHERE Device IS ? ORDER BY rowid", (device,))
+            while True:
+                chunk = notifications.fetchmany(batch_size)
+                if not chunk:
+                    return
+                for channel, data in chunk:
+                    yield data if channel == OmronMeasurementWS.CHARACTERISTIC_UUID else None
+
+        stored = failed = 0
+        rows = []
+        with metrics.span("reprocess"), self.conn:
+            for device in devices:
+                offset = user_offsets.get(device, 0)
+                feature = features.get(device)
+                assembler = FrameAssembler(feature)
+                # one OmronMeasurementWS per record instead of decode_many: the two packets of a record are
+                # archived as separate notifications, the fixed-point columns need the exact Decimals
+                # (decode_many returns floats) and a broken record only fails itself, not its whole group
+                for data1, data2 in frame_packets(packets(device), assembler=assembler):
+                    try:
+                        measurement = OmronMeasurementWS(data1=data1, data2=data2, feature=feature)
+                        measurement.mUserID += offset
+                        rows.append(measurement_row(measurement))
+                    except (ValueError, TypeError, IndexError, struct.error):
+                        failed += 1
+                        continue
+                    if len(rows) >= batch_size:
+                        self.cursor.executemany(UPSERT_MEASUREMENT, rows)
+                        stored += len(rows)
+                        rows = []
+                # packets that could not be framed
+                failed += assembler.dropped
+            if rows:
+                self.cursor.executemany(UPSERT_MEASUREMENT, rows)
+                stored += len(rows)
+            if stored:
+                # updated rows keep their rowid, so the delta replication has to start over with a full copy
+                self.cursor.execute("DELETE FROM replication")
+        return stored, failed
+
+    def get_outbox(self, limit):
+        # [(rowid, measurement as a dict keyed by MEASUREMENT_COLUMNS), ...] of the oldest undelivered measurements
+        self.cursor.execute(
+            f"""
+            SELECT measurements_fixed.rowid, {MEASUREMENT_SELECT} FROM outbox
+            JOIN measurements_fixed ON measurements_fixed.rowid = outbox.MeasurementRowid
+            WHERE outbox.Delivered IS NULL ORDER BY outbox.MeasurementRowid LIMIT ?
+        """,
+            (limit,),
+        )
+        return [(row[0], dict(zip(MEASUREMENT_COLUMNS, row[1:]))) for row in self.cursor.fetchall()]
+
+    def mark_delivered(self, rowids):
+        now = int(time.time())
+        with self.conn:
+            self.cursor.executemany(
+                "UPDATE outbox SET Delivered = ? WHERE MeasurementRowid = ?", [(now, rowid) for rowid in rowids]
+            )
+            self.cursor.execute("DELETE FROM outbox WHERE Delivered < ?", (now - OUTBOX_RETENTION_SECONDS,))
+
+    def get_replication_watermark(self, remote):
+        # (MeasurementsRowid, SyncsRowid) already shipped to remote, None if it was never bootstrapped
+        self.cursor.execute(
+            """
+            SELECT MeasurementsRowid, SyncsRowid FROM replication WHERE Remote = ?
+        """,
+            (remote,),
+        )
+        return self.cursor.fetchone()
+
+    def store_replication_watermark(self, remote, watermark):
         self.cursor.execute(
             """
-            INSERT INTO measurements (SequenceNumber, TimeStamp, UserID, Weight, BMI, Height, BodyFatPercentage, BasalMetabolism, SkeletalMusclePercentage, VisceralFatLevel, BodyAge)
-            VALUES (?, ?, ?, ?, ?, ?,?,?,?,?,?)
-        """,
-            (
-                int(measurement.mSequenceNumber),
-                int(measurement.mTimeStamp),
-                int(measurement.mUserID),
-                measurement.mWeight,
-                measurement.mBMI,
-                measurement.mHeight,
-                measurement.mBodyFatPercentage,
-                int(measurement.mBasalMetabolism),
-                measurement.mSkeletalMusclePercentage,
-                measurement.mVisceralFatLevel,
-                int(measurement.mBodyAge),
-            ),
+            INSERT OR REPLACE INTO replication (Remote, MeasurementsRowid, SyncsRowid) VALUES (?, ?, ?)
+        """,
+            (remote, watermark[0], watermark[1]),
         )
         self.conn.commit()
 
+    def get_rows_after(self, table, rowid):
+        # (column names, rows) of table with a rowid above the given one, in insertion order
+        self.cursor.execute(f"SELECT rowid, * FROM {table} WHERE rowid > ? ORDER BY rowid", (rowid,))
+        rows = self.cursor.fetchall()
+        return [column[0] for column in self.cursor.description], rows
+
+    def get_schema_version(self):
+        self.cursor.execute("PRAGMA user_version")
+        return self.cursor.fetchone()[0]
+
+    def snapshot(self, target):
+        # writes a consistent single file copy of the database to target using the online backup API
+        # returns the watermark of the copy, the highest rowids of measurements_fixed and syncs
+        snapshot = sqlite3.connect(target)
+        try:
+            with metrics.span("snapshot"):
+                self.conn.backup(snapshot)
+            snapshot.execute("PRAGMA journal_mode = DELETE")
+            return snapshot.execute(
+                """
+                SELECT (SELECT IFNULL(MAX(rowid), 0) FROM measurements_fixed), (SELECT IFNULL(MAX(rowid), 0) FROM syncs)
+            """
+            ).fetchone()
+        finally:
+            snapshot.close()
+
     def close(self):
+        self.flush_notifications()
         self.conn.close()
 
 
-def adapt_decimal(d):
-    return str(d)
+def measurement_row(measurement):
+    # the scaled values as sent by the scale, see SCALED_COLUMNS
+    raw = measurement.mRaw
+    return (
+        int(measurement.mSequenceNumber),
+        int(measurement.mTimeStamp),
+        int(measurement.mUserID),
+        raw.get("mWeight"),
+        raw.get("mBMI"),
+        raw.get("mHeight"),
+        raw.get("mBodyFatPercentage"),
+        int(measurement.mBasalMetabolism),
+        raw.get("mSkeletalMusclePercentage"),
+        raw.get("mVisceralFatLevel"),
+        int(measurement.mBodyAge),
+        raw.get("mMusclePercentage"),
+        raw.get("mMuscleMass"),
+        raw.get("mFatFreeMass"),
+        raw.get("mSoftLeanMass"),
+        raw.get("mBodyWaterMass"),
+        raw.get("mImpedance"),
+        optional_int(measurement.mBodyFatPercentageStageEvaluation),
+        optional_int(measurement.mSkeletalMusclePercentageStageEvaluation),
+        optional_int(measurement.mVisceralFatLevelStageEvaluation),
+        int(measurement.mWeightUnit == OmronMeasurementWS.WEIGHT_UNIT_POUND),
+        measurement.mWeightResolutionCode,
+        measurement.mHeightResolutionCode,
+    )
 
 
-def convert_decimal(s):
-    return D(s)
+def optional_int(value):
+    return None if value is None else int(value)
 
 
 # test usage
@@ -119,6 +753,7 @@ if __name__ == "__main__":
     data = bytearray.fromhex(
         "3e00100100903de8070c010a173801fe00e006c2c01f0100e9009a1b600108340906063e00100200903de8070c010a2b1701fe00e006c2c01f0200ec00471b570108370906063e00100300cc3de8070c1e101c2d01ff00e006c2c01f0300dd00bb1c7e01082b090606"
     )
-    for i in range(0, len(data), 35):
-        bcm = OmronMeasurementWS(data1=data[i : i + 19], data2=data[i + 19 : i + 35])
-        persistence.persist_measurement(bcm)
+    # the packet sizes follow from their flags
+    measurements = [OmronMeasurementWS(data1=data1, data2=data2) for data1, data2 in frame_packets([data])]
+    inserted, skipped = persistence.persist_many(measurements)
+    print(f"{inserted} inserted, {skipped} skipped")
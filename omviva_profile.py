@@ -0,0 +1,67 @@
+# device profile of a scale: firmware revision, Body Composition Feature and the handles of the characteristics
+#
+# OmronBLE reads the profile once per device and firmware and keeps it in omviva_devices.json:
+#
+#   "00:5F:BF:00:00:00": {
+#       "firmware": "1.04",
+#       "profiles": {"1.04": {"feature": 6293, "handles": {"00002a52-...": 1552, ...}}}
+#   }
+#
+# Later connects only read the firmware revision. The feature gives the weight and height resolutions the
+# measurements are decoded with, the handles give the table the notifications are dispatched by.
+# It only depends on the standard library and omviva_measurement, so reprocess can use it without bleak.
+
+import json
+from pathlib import Path
+
+from omviva_measurement import BodyCompositionFeature
+
+FIRMWARE_REVISION_UUID = "00002a26-0000-1000-8000-00805f9b34fb"
+BODY_COMPOSITION_FEATURE_UUID = "00002a9b-0000-1000-8000-00805f9b34fb"
+# used when the device has no firmware revision characteristic
+UNKNOWN_FIRMWARE = "unknown"
+
+
+class DeviceProfile:
+    def __init__(self, firmware, feature=None, handles=None):
+        self.firmware = firmware
+        # Body Composition Feature as a 32 bit word, None if the device does not have one
+        self.feature = feature
+        # characteristic uuid -> handle
+        self.handles = handles or {}
+        self.body_composition_feature = parse_feature(feature)
+
+    def dispatch_table(self, uuids):
+        # handle -> index in uuids of the characteristics the profile knows
+        return {self.handles[uuid]: index for index, uuid in enumerate(uuids) if uuid in self.handles}
+
+    def to_json(self):
+        return {"feature": self.feature, "handles": self.handles}
+
+    @staticmethod
+    def from_json(firmware, data):
+        return DeviceProfile(firmware, data.get("feature"), data.get("handles"))
+
+
+def parse_feature(feature):
+    # BodyCompositionFeature for the word, None (default resolutions) without one or with a reserved resolution code
+    if feature is None:
+        return None
+    try:
+        return BodyCompositionFeature(feature.to_bytes(4, "little"))
+    except IndexError:
+        return None
+
+
+def load_features(cache_file):
+    # MAC -> BodyCompositionFeature (or None) of the firmware each device was last seen with
+    if cache_file is None or not Path(cache_file).exists():
+        return {}
+    with open(cache_file, "r") as cache:
+        devices = json.load(cache)
+    features = {}
+    for mac, device in devices.items():
+        profile = device.get("profiles", {}).get(device.get("firmware"))
+        if profile is not None:
+            features[mac] = parse_feature(profile.get("feature"))
+    return features
@@ -0,0 +1,99 @@
+# incremental replication of the measurements database to a remote copy
+#
+# The sender keeps a rowid watermark per remote (table replication) and ships the measurements and syncs rows
+# added since then as a gzip compressed JSON changeset. This file is also copied to the remote host when the
+# remote copy is bootstrapped and merges a changeset into the remote database there:
+#
+#   python3 omviva_replication.py apply omviva_changeset.json.gz viva_measurements.db
+#
+# It only depends on the standard library, so it runs on the remote host without the rest of omviva.
+
+import gzip
+import json
+import sqlite3
+import sys
+
+CHANGESET_VERSION = 2
+CHANGESET_NAME = "omviva_changeset.json.gz"
+
+# exit codes of the applier
+EXIT_OK = 0
+EXIT_USAGE = 2
+EXIT_SCHEMA_MISMATCH = 3
+
+
+class SchemaMismatchError(Exception):
+    pass
+
+
+def build_changeset(persistence, watermark):
+    # returns (changeset bytes or None if there is nothing new, new watermark)
+    tables = {}
+    new_watermark = list(watermark)
+    for index, table in enumerate(("measurements_fixed", "syncs")):
+        columns, rows = persistence.get_rows_after(table, watermark[index])
+        if rows:
+            # the rowid is only used for the watermark, the remote assigns its own
+            tables[table] = {"columns": columns[1:], "rows": [list(row[1:]) for row in rows]}
+            new_watermark[index] = rows[-1][0]
+    if not tables:
+        return None, tuple(new_watermark)
+
+    changeset = {"version": CHANGESET_VERSION, "schema": persistence.get_schema_version(), "tables": tables}
+    data = gzip.compress(json.dumps(changeset, separators=(",", ":")).encode("utf-8"))
+    return data, tuple(new_watermark)
+
+
+def apply_changeset(db_name, data):
+    # merges a changeset into db_name in one transaction, returns the number of new rows per table
+    changeset = json.loads(gzip.decompress(data).decode("utf-8"))
+    conn = sqlite3.connect(db_name)
+    try:
+        schema = conn.execute("PRAGMA user_version").fetchone()[0]
+        if changeset["version"] != CHANGESET_VERSION or changeset["schema"] != schema:
+            raise SchemaMismatchError(
+                f"changeset version {changeset['version']} schema {changeset['schema']}, database schema {schema}"
+            )
+
+        applied = {}
+        with conn:
+            for table, content in changeset["tables"].items():
+                columns = content["columns"]
+                names = ", ".join(columns)
+                placeholders = ", ".join("?" * len(columns))
+                if table == "measurements_fixed":
+                    # unique per (UserID, SequenceNumber)
+                    statement = f"INSERT OR IGNORE INTO measurements_fixed ({names}) VALUES ({placeholders})"
+                    parameters = content["rows"]
+                else:
+                    # syncs has no unique key, skip rows that are already there
+                    match = " AND ".join(f"{column} IS ?" for column in columns)
+                    statement = (
+                        f"INSERT INTO {table} ({names}) SELECT {placeholders} "
+                        f"WHERE NOT EXISTS (SELECT 1 FROM {table} WHERE {match})"
+                    )
+                    parameters = [row + row for row in content["rows"]]
+                # rowcount leaves out rows changed by triggers on the remote database
+                applied[table] = max(conn.executemany(statement, parameters).rowcount, 0)
+        return applied
+    finally:
+        conn.close()
+
+
+def main(argv):
+    if len(argv) != 4 or argv[1] != "apply":
+        print(f"usage: {argv[0]} apply <changeset> <database>")
+        return EXIT_USAGE
+    with open(argv[2], "rb") as changeset:
+        data = changeset.read()
+    try:
+        applied = apply_changeset(argv[3], data)
+    except SchemaMismatchError as e:
+        print(f"Schema mismatch: {e}")
+        return EXIT_SCHEMA_MISMATCH
+    print(", ".join(f"{count} new {table}" for table, count in applied.items()))
+    return EXIT_OK
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,239 @@
+# simulated Omron VIVA for running OmronBLE, sync() and VivaPersistence without a physical scale
+#
+# FakeScale holds the records of each user and answers the user control point and record access control point
+# requests like the scale does. Its client_factory creates FakeBleakClient objects, which stand in for
+# bleak.BleakClient (see OmronBLE client_factory). Measurement notifications are replayed from the capture in
+# omviva_persistence.py with the sequence number, user and time stamp of each record patched in.
+
+import asyncio
+import time
+from bleak.exc import BleakError
+from omviva_comms import OmronBLE
+from omviva_profile import FIRMWARE_REVISION_UUID, BODY_COMPOSITION_FEATURE_UUID
+
+# captured notifications of three records, two packets per record
+TRACE = bytes.fromhex(
+    "3e00100100903de8070c010a173801fe00e006c2c01f0100e9009a1b600108340906063e00100200903de8070c010a2b1701fe00e006c2c01f0200ec00471b570108370906063e00100300cc3de8070c1e101c2d01ff00e006c2c01f0300dd00bb1c7e01082b090606"
+)
+TRACE_RECORD_SIZE = 35
+TRACE_FIRST_PACKET_SIZE = 19
+
+# number of records the scale keeps per user
+SCALE_MEMORY_RECORDS = 30
+
+SERVICE_UUID = "0000181b-0000-1000-8000-00805f9b34fb"
+DEVICE_INFORMATION_SERVICE_UUID = "0000180a-0000-1000-8000-00805f9b34fb"
+# handles of the profile characteristics
+FIRMWARE_REVISION_HANDLE = 0x210
+BODY_COMPOSITION_FEATURE_HANDLE = 0x600
+
+
+class FakeCharacteristic:
+    def __init__(self, uuid, handle, service_uuid=SERVICE_UUID):
+        self.uuid = uuid
+        self.handle = handle
+        self.service_uuid = service_uuid
+
+    def __str__(self):
+        return f"{self.uuid} (Handle: {self.handle})"
+
+
+class FakeServices:
+    def __init__(self, characteristics):
+        self.characteristics = characteristics
+
+    def get_characteristic(self, uuid):
+        return self.characteristics.get(uuid)
+
+
+class FakeScale:
+    # response_delay: seconds until a control point answers
+    # packet_delay: seconds between two measurement notifications
+    # drop_after: drop the link after that many notifications (once), None to keep it
+    # answer_finish: whether the final 1000 request is answered
+    # firmware: the firmware revision string, feature: the Body Composition Feature word (None if there is none)
+    # handles: uuid -> handle of the channels, for firmware with other handles than OmronBLE expects
+
+    def __init__(
+        self,
+        records_per_user,
+        response_delay=0.05,
+        packet_delay=0.01,
+        drop_after=None,
+        answer_finish=True,
+        firmware="1.00",
+        feature=None,
+        handles=None,
+    ):
+        self.records = {
+            user: [make_record(user, sequence) for sequence in range(1, count + 1)]
+            for user, count in records_per_user.items()
+        }
+        self.response_delay = response_delay
+        self.packet_delay = packet_delay
+        self.drop_after = drop_after
+        self.answer_finish = answer_finish
+        self.firmware = firmware
+        self.feature = feature
+        if handles is None:
+            handles = dict(zip(OmronBLE.DEVICE_RX_CHANNEL_UUIDS, OmronBLE.DEVICE_DATA_RX_CHANNEL_INT_HANDLES))
+        self.handles = handles
+        # uuids of all characteristic reads
+        self.reads = []
+        self.user = None
+        self.notifications_sent = 0
+        # (time, event) of everything that happened, see phases
+        self.events = []
+
+    def client_factory(self, address, timeout=10, services=None, disconnected_callback=None, **kwargs):
+        return FakeBleakClient(self, address, disconnected_callback)
+
+    def log(self, event):
+        self.events.append((time.perf_counter(), event))
+
+    def answer(self, client, char, data):
+        opcode = data[0]
+        if char == OmronBLE.USER_CONTROL_POINT:
+            if opcode == 0x02:
+                known = data[1] in self.records
+                if known:
+                    self.user = data[1]
+                client.notify_later(self.response_delay, char, bytes([0x20, opcode, 0x01 if known else 0x05]))
+            else:
+                client.notify_later(self.response_delay, char, bytes([0x20, opcode, 0x01, len(self.records) + 1]))
+            return
+
+        first_sequence = int.from_bytes(data[3:5], "little")
+        records = [record for sequence, record in self.records.get(self.user, []) if sequence >= first_sequence]
+        if opcode == 0x04:
+            client.notify_later(self.response_delay, char, bytes([0x05, 0x00]) + len(records).to_bytes(2, "little"))
+        elif opcode == 0x01:
+            delay = self.response_delay
+            for record in records:
+                for packet in (record[:TRACE_FIRST_PACKET_SIZE], record[TRACE_FIRST_PACKET_SIZE:]):
+                    client.notify_later(delay, OmronBLE.OMRON_MEASUREMENT_WS, packet)
+                    delay += self.packet_delay
+            client.notify_later(delay, char, bytes([0x06, 0x00, 0x01, 0x01 if records else 0x06]))
+        elif opcode == 0x10 and self.answer_finish:
+            client.notify_later(self.response_delay, char, bytes([0x06, 0x00, 0x10, 0x01]))
+
+    def phases(self):
+        # seconds spent in each phase of the last connection, taken from the event log
+        marks = {}
+        for at, event in self.events:
+            if event == "connect" or event not in marks:
+                marks[event] = at
+            if event == "connect":
+                for later in ("connected", "write", "transfer", "transferred", "disconnected"):
+                    marks.pop(later, None)
+        order = [
+            ("connect", "connected"),
+            ("setup", "write"),
+            ("query", "transfer"),
+            ("transfer", "transferred"),
+            ("finish", "disconnected"),
+        ]
+        phases = {}
+        start = marks.get("connect")
+        for name, end in order:
+            if start is not None and end in marks:
+                phases[name] = marks[end] - start
+                start = marks[end]
+        return phases
+
+
+class FakeBleakClient:
+    def __init__(self, scale, address, disconnected_callback=None):
+        self.scale = scale
+        self.address = address
+        self.disconnected_callback = disconnected_callback
+        self.is_connected = False
+        self.callbacks = {}
+        self.handles = {uuid: FakeCharacteristic(uuid, handle) for uuid, handle in scale.handles.items()}
+        characteristics = dict(self.handles)
+        characteristics[FIRMWARE_REVISION_UUID] = FakeCharacteristic(
+            FIRMWARE_REVISION_UUID, FIRMWARE_REVISION_HANDLE, DEVICE_INFORMATION_SERVICE_UUID
+        )
+        if scale.feature is not None:
+            characteristics[BODY_COMPOSITION_FEATURE_UUID] = FakeCharacteristic(
+                BODY_COMPOSITION_FEATURE_UUID, BODY_COMPOSITION_FEATURE_HANDLE
+            )
+        self.services = FakeServices(characteristics)
+
+    async def connect(self):
+        self.scale.log("connect")
+        await asyncio.sleep(self.scale.response_delay)
+        self.is_connected = True
+        self.scale.log("connected")
+
+    async def pair(self, protection_level=None):
+        await asyncio.sleep(self.scale.response_delay)
+
+    async def unpair(self):
+        pass
+
+    async def disconnect(self):
+        self.is_connected = False
+        self.callbacks = {}
+        self.scale.log("disconnected")
+
+    async def read_gatt_char(self, uuid):
+        self._check_connected()
+        self.scale.reads.append(uuid)
+        await asyncio.sleep(self.scale.response_delay)
+        if uuid == FIRMWARE_REVISION_UUID:
+            return bytearray(self.scale.firmware.encode("utf-8"))
+        return bytearray(self.scale.feature.to_bytes(4, "little"))
+
+    async def start_notify(self, uuid, callback):
+        self._check_connected()
+        self.callbacks[uuid] = callback
+
+    async def stop_notify(self, uuid):
+        self._check_connected()
+        self.callbacks.pop(uuid, None)
+
+    async def write_gatt_char(self, char, data, response=None):
+        self._check_connected()
+        self.scale.log("write")
+        if char == OmronBLE.RECORD_ACCESS_CONTROL_POINT and data[0] == 0x01:
+            self.scale.log("transfer")
+        self.scale.answer(self, char, bytes(data))
+
+    def notify_later(self, delay, uuid, data):
+        asyncio.get_running_loop().call_later(delay, self._notify, uuid, data)
+
+    def _notify(self, uuid, data):
+        if not self.is_connected or uuid not in self.callbacks:
+            return
+        if uuid == OmronBLE.OMRON_MEASUREMENT_WS:
+            if self.scale.drop_after is not None and self.scale.notifications_sent >= self.scale.drop_after:
+                self.scale.drop_after = None
+                self._drop()
+                return
+            self.scale.notifications_sent += 1
+        elif uuid == OmronBLE.RECORD_ACCESS_CONTROL_POINT and data[0] == 0x06 and data[2] == 0x01:
+            self.scale.log("transferred")
+        self.callbacks[uuid](self.handles[uuid], bytearray(data))
+
+    def _drop(self):
+        self.is_connected = False
+        self.callbacks = {}
+        self.scale.log("dropped")
+        if self.disconnected_callback is not None:
+            self.disconnected_callback(self)
+
+    def _check_connected(self):
+        if not self.is_connected:
+            raise BleakError("Not connected")
+
+
+def make_record(user, sequence, timestamp=None):
+    # (sequence, record bytes) based on the captured trace
+    record = bytearray(TRACE[:TRACE_RECORD_SIZE])
+    timestamp = time.gmtime(timestamp if timestamp is not None else 1700000000 + sequence * 86400)
+    record[3:5] = sequence.to_bytes(2, "little")
+    record[7:14] = timestamp.tm_year.to_bytes(2, "little") + bytes(timestamp[1:6])
+    record[14] = user
+    record[TRACE_FIRST_PACKET_SIZE + 3 : TRACE_FIRST_PACKET_SIZE + 5] = sequence.to_bytes(2, "little")
+    return sequence, bytes(record)
@@ -0,0 +1,106 @@
+# checks the import time of every omviva.py command against a startup budget
+#
+#   python3 omviva_startup.py --budget 0.5 --top 5
+#
+# Every command is started through omviva.main in a fresh interpreter with -X importtime, in a temporary directory
+# and with config-example.json as its configuration (without uploads, metrics server and Loki). It runs for
+# --seconds, which covers the imports a command does before it waits for the scale or the broker, and is then
+# cancelled. The connections it starts meanwhile go to the example addresses and fail or are cancelled.
+# Exits with 1 if a command exceeds the budget. Commands whose modules are not installed are reported and skipped.
+
+import argparse
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+
+# command -> arguments of omviva.py
+COMMANDS = {
+    "decode": ["decode"],
+    "export": ["export", "csv", "-"],
+    "reprocess": ["reprocess"],
+    "pair": ["pair", "1"],
+    "sync-once": ["sync-once"],
+    "run --trigger mqtt": ["run", "--trigger", "mqtt"],
+    "run --trigger bt": ["run", "--trigger", "bt"],
+}
+# replaced in config-example.json, so the check does not upload, serve or log anywhere
+CONFIG_OVERRIDES = {"SCP_HOST": "", "MQTT_HOST": "localhost", "METRICS_PORT": None, "LOG_LOKI": False}
+BUDGET_SECONDS = 0.5
+RUN_SECONDS = 1.0
+
+# runs omviva.main with the example configuration, stopping the event loop after the given seconds
+RUNNER = """
+import asyncio, json, sys
+sys.path.insert(0, {directory!r})
+import omviva
+config = json.load(open({config!r}))
+config.update({overrides!r})
+omviva.getConfig = lambda: config
+run = asyncio.run
+asyncio.run = lambda main: run(asyncio.wait_for(main, {seconds!r}))
+try:
+    omviva.main({argv!r})
+except ImportError:
+    raise
+except BaseException as e:
+    print(f"stopped: {{e!r}}", file=sys.stderr)
+"""
+
+
+def measure(argv, seconds):
+    # returns ({top level module: cumulative seconds}, error message or None)
+    directory = Path(__file__).parent
+    statement = RUNNER.format(
+        directory=str(directory),
+        config=str(directory / "config-example.json"),
+        overrides=CONFIG_OVERRIDES,
+        seconds=seconds,
+        argv=argv,
+    )
+    # the databases the commands create end up in the temporary directory
+    with tempfile.TemporaryDirectory() as workdir:
+        result = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", statement],
+            cwd=workdir,
+            capture_output=True,
+            text=True,
+        )
+    timings = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        fields = line[len("import time:") :].split("|")
+        name = fields[2]
+        # nested imports are indented, their time is part of the top level one
+        if fields[1].strip().isdigit() and not name[1:].startswith(" "):
+            timings[name.strip()] = int(fields[1]) / 1e6
+    if result.returncode != 0:
+        return timings, result.stderr.strip().splitlines()[-1]
+    return timings, None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Check the startup import time of the omviva commands")
+    parser.add_argument("--budget", type=float, default=BUDGET_SECONDS, help="seconds allowed per command")
+    parser.add_argument("--top", type=int, default=3, help="number of slowest imports to list")
+    parser.add_argument("--seconds", type=float, default=RUN_SECONDS, help="seconds every command runs")
+    args = parser.parse_args(argv)
+
+    failed = False
+    for command, argv in COMMANDS.items():
+        timings, error = measure(argv, args.seconds)
+        if error is not None:
+            print(f"{command:22} skipped: {error}")
+            continue
+        total = sum(timings.values())
+        status = "ok" if total <= args.budget else "OVER BUDGET"
+        failed = failed or total > args.budget
+        slowest = sorted(timings.items(), key=lambda item: item[1], reverse=True)[: args.top]
+        details = ", ".join(f"{name} {seconds * 1000:.0f}ms" for name, seconds in slowest)
+        print(f"{command:22} {total * 1000:6.0f}ms {status:11} ({details})")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())